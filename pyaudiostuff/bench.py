@@ -0,0 +1,223 @@
+"""
+Benchmarks for the synthesis pipeline. Run from this directory:
+
+    python bench.py [--quick] [--only render] [--save baseline.json] [--compare baseline.json]
+
+Every case reports the best of ``--repeat`` timed runs as items (samples or notes) per second, and the peak memory
+traced over one further run. ``--save`` writes the results as a JSON baseline; ``--compare`` checks against one and
+exits non-zero if any case got slower or hungrier than ``--tolerance`` allows.
+"""
+import argparse
+import collections
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from music import constants
+from music import render
+from music import tone
+from music import wav
+from utils import decorator
+
+BENCHMARKS = collections.OrderedDict()
+
+Case = collections.namedtuple('Case', ['name', 'run', 'items', 'unit'])
+Result = collections.namedtuple('Result', ['seconds', 'rate', 'peak'])
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def _harmonics(count):
+    harmonics = {}
+    for table in (constants.Harmonics.inharmonic, constants.Harmonics.inharmonic2,
+                  constants.Harmonics.inharmonic3, constants.Harmonics.exp_decayed):
+        harmonics.update(table)
+    return dict(sorted(harmonics.items())[:count])
+
+
+def _note_starts(count, seed=0):
+    """
+    Start times of a synthetic performance: chords of one to four notes on a jittered grid of eighths and quarters.
+    """
+    rng = np.random.default_rng(seed)
+    onsets = np.cumsum(rng.choice([.25, .5], count) + rng.normal(0, .01, count))
+    starts = np.repeat(onsets, rng.integers(1, 5, count))[:count]
+    return starts + rng.uniform(0, .01, count)
+
+
+@benchmark
+def tone_render(quick):
+    f = tone.ToneFactory(2, 22050, 1)
+    for beats in (.25, 1, 4):
+        n = f.sample_count(beats)
+        ampl = f.get_linear_decay(beats, .5, .8)
+        yield Case('ToneFactory.render beats={}'.format(beats),
+                   lambda: tone.ToneFactory.render._wrapped(f, 440, ampl, beats), n, 'samples')
+
+
+@benchmark
+def htone_render(quick):
+    for count in (1, 8, 32) if quick else (1, 4, 8, 16, 32):
+        f = tone.HToneFactory(2, 22050, 1, harmonics=_harmonics(count))
+        for beats in (.25, 1, 4):
+            n = f.sample_count(beats)
+            ampl = f.get_linear_decay(beats, .5, .8)
+            yield Case('HToneFactory.render harmonics={} beats={}'.format(len(f.harmonics), beats),
+                       lambda f=f, ampl=ampl, beats=beats: tone.HToneFactory.render._wrapped(f, 440, ampl, beats),
+                       n, 'samples')
+
+
+@benchmark
+def linear_decay(quick):
+    f = tone.ToneFactory(2, 22050, 1)
+    for beats in (.25, 1, 4, 16):
+        yield Case('get_linear_decay beats={}'.format(beats),
+                   lambda beats=beats: tone.ToneFactory.get_linear_decay._wrapped(f, beats, .5, .8),
+                   f.sample_count(beats), 'samples')
+
+
+class _Memoized(object):
+    @decorator.memoize_instance_method
+    def method(self, a, b=1):
+        return a
+
+
+@benchmark
+def memoize(quick):
+    count = 10000 if quick else 100000
+    obj = _Memoized()
+
+    def hits():
+        for _ in range(count):
+            obj.method(1, b=2)
+
+    def misses():
+        _Memoized.method.cache_clear(obj)
+        for i in range(count):
+            obj.method(i, b=2)
+
+    yield Case('memoize_instance_method hit', hits, count, 'calls')
+    yield Case('memoize_instance_method miss', misses, count, 'calls')
+
+
+@benchmark
+def melody(quick):
+    f = tone.HToneFactory(2, 22050, 1, harmonics=_harmonics(8))
+    total = sum(f.sample_count(render.note_beats(note)) for note in tone.melody.notes)
+
+    def stream():
+        for _ in render.stream_line(f, tone.melody):
+            pass
+
+    yield Case('melody stream_line (cold)', lambda: (f.__dict__.pop('_memoized', None), stream()), total, 'samples')
+    yield Case('melody stream_line (warm)', stream, total, 'samples')
+    yield Case('melody render_line_parallel', lambda: render.render_line_parallel(f, tone.melody), total, 'samples')
+
+
+@benchmark
+def write_wave(quick):
+    f = tone.ToneFactory(2, 22050, 1)
+    seconds = 10 if quick else 120
+    block = np.sin(np.arange(render.BLOCK_SIZE) / 10) * 10000
+    count = seconds * f.framerate // len(block)
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'bench.wav')
+
+    def write(nframes=None):
+        wav.write_blocks(filename, f.framerate, f.width, (block for _ in range(count)), nframes=nframes)
+        os.unlink(filename)
+
+    yield Case('write_wave {}s streamed'.format(seconds), write, count * len(block), 'samples')
+    yield Case('write_wave {}s memmap'.format(seconds), lambda: write(count * len(block)), count * len(block),
+               'samples')
+
+
+@benchmark
+def rhythm(quick):
+    from music import midi_in
+
+    for count in (10 ** 3, 10 ** 4) if quick else (10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6):
+        starts = _note_starts(count)
+        log = midi_in.NoteLog(count)
+        for i, start in enumerate(starts):
+            log.append(start, 40 + i % 30, 64, end=start + .2)
+        chord_starts = log.start[midi_in.chord_boundaries(log.start)]
+        yield Case('group_chords notes={}'.format(count), lambda log=log: midi_in.group_chords(log), count, 'notes')
+        yield Case('infer_rhythm notes={}'.format(count),
+                   lambda s=chord_starts: midi_in.infer_rhythm_array(s, hint=.05), count, 'notes')
+
+
+def measure(case, repeat):
+    case.run()  # warm up
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        case.run()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        case.run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return Result(best, case.items / best if best else float('inf'), peak)
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: descriptions of the cases that regressed against ``baseline``
+    """
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if result.rate < old['rate'] * (1 - tolerance):
+            regressions.append('{}: {:.3g} -> {:.3g} per second'.format(name, old['rate'], result.rate))
+        if result.peak > old['peak'] * (1 + tolerance) + 1024 * 1024:
+            regressions.append('{}: peak {:.1f} -> {:.1f} MiB'.format(name, old['peak'] / 2 ** 20,
+                                                                       result.peak / 2 ** 20))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help='fewer and smaller cases')
+    parser.add_argument('--only', action='append', choices=list(BENCHMARKS), help='benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--save', help='write the results to this JSON baseline')
+    parser.add_argument('--compare', help='JSON baseline to check the results against')
+    parser.add_argument('--tolerance', type=float, default=.2, help='allowed fractional slowdown or memory growth')
+    args = parser.parse_args(argv)
+
+    results = collections.OrderedDict()
+    for name in args.only or BENCHMARKS:
+        for case in BENCHMARKS[name](args.quick):
+            result = results[case.name] = measure(case, args.repeat)
+            print('{:<50} {:>12.4g} {}/s {:>10.3f} ms {:>9.1f} MiB peak'.format(
+                case.name, result.rate, case.unit, result.seconds * 1000, result.peak / 2 ** 20))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(dict(python=platform.python_version(), numpy=np.__version__, machine=platform.machine(),
+                           results={name: r._asdict() for name, r in results.items()}), f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
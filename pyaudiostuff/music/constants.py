@@ -1,6 +1,9 @@
 from enum import Enum
+import functools
 import math
 
+import numpy as np
+
 
 class Harmonics(object):
     simple = {i: 1/i for i in range(1, 11)}
@@ -91,9 +94,10 @@ class WesternTuning(object):
         B=6,
     )
 
+    midi_keys = 128
+
     def __init__(self, key, tuning_preferences, renormalization=None):
         self.key, self.tonic = (key, EqualTempered[key].value) if isinstance(key, str) else key
-        print('key', self.key, self.tonic)
         _flipped = {_v: _i for _i, _v in enumerate(EqualTempered)}
         self._notes = {_n: _flipped[_v] for _n, _v in EqualTempered.__members__.items()}
         if not isinstance(tuning_preferences[0][0], tuple):
@@ -103,24 +107,55 @@ class WesternTuning(object):
         for i in range(12):
             for tuning in tuning_preferences:
                 if tuning[i]:
-                    print(tuning[i])
                     n, d = tuning[i]
                     pitches.append(self.tonic * n / d)
                     break
             else:
                 raise ValueError('Please add a more complete tuning to your tuning_preferences to fill gaps')
         n = self._notes[self.key]
-        print(self._notes)
-        self.pitches = [p/2 for p in pitches[-n:]] + pitches[:-n]
+        self.pitches = [p/2 for p in pitches[12 - n:]] + pitches[:12 - n]
         if renormalization is not None and renormalization != self.key:
             adjustment = EqualTempered[renormalization].value / self[renormalization]
             self.pitches = [adjustment * p for p in self.pitches]
+        # Frequencies of every MIDI key, in the convention of BaseNoteObject.freq: key k is octave k // 12 - 1.
+        keys = np.arange(self.midi_keys)
+        self.table = np.asarray(self.pitches)[keys % 12] * 2. ** (keys // 12 - 4)
+        self.table.flags.writeable = False
 
     def __getitem__(self, note_name):
-        result = self.pitches[self._notes[note_name]]
-        print(note_name, result)
-        return result
+        return self.pitches[self._notes[note_name]]
+
+    def freqs_from_midi(self, keys):
+        """
+        :param keys: MIDI key numbers (``LiveListener`` piano keys plus ``midi_in.MIDI_OFFSET``), any shape
+        :return: np.ndarray of frequencies, as ``NamedTone.freq`` gives them
+        """
+        keys = np.asarray(keys)
+        if keys.size and (keys.min() < 0 or keys.max() >= self.midi_keys):
+            raise IndexError('MIDI keys must be between 0 and {}'.format(self.midi_keys - 1))
+        return self.table[keys]
+
+    def freqs(self, note_names, octaves):
+        """
+        ``NamedTone(name, octave).freq`` over arrays (or scalars) of note names and octaves, which broadcast.
+        """
+        names, inverse = np.unique(np.asarray(note_names), return_inverse=True)
+        positions = np.array([self.positions[name] for name in names], np.int64)[inverse]
+        positions = positions.reshape(np.shape(note_names))
+        return self.freqs_from_midi(12 * (np.asarray(octaves) + 1) + positions)
 
     def __getattr__(self, item):
         return self[item]
 
+
+
+def get_tuning(key, tuning_preferences=minor_ratios, renormalization=None):
+    """
+    A shared ``WesternTuning``, built once per combination of arguments. Treat it as read-only.
+    """
+    return _get_tuning(key, tuning_preferences, renormalization)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_tuning(key, tuning_preferences, renormalization):
+    return WesternTuning(key, tuning_preferences, renormalization)
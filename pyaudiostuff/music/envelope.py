@@ -0,0 +1,143 @@
+import numpy as np
+
+_RAMP = np.arange(0, dtype=np.float64)
+
+
+def _ramp(n):
+    global _RAMP
+    if len(_RAMP) < n:
+        _RAMP = np.arange(max(n, 2 * len(_RAMP)), dtype=np.float64)
+    return _RAMP[:n]
+
+
+def linear_segment(out, y0, y1):
+    """
+    Fills ``out`` with a line from ``y0`` (at ``out[0]``) towards ``y1`` (just past ``out[-1]``), as ``np.interp``
+    would between two breakpoints, without allocating.
+    """
+    if not len(out):
+        return out
+    np.multiply(_ramp(len(out)), (y1 - y0) / len(out), out=out)
+    out += y0
+    return out
+
+
+def exponential_segment(out, y0, rate):
+    """
+    Fills ``out`` with ``y0 * exp(-rate * t)`` for t = 0, 1, 2, ...
+    """
+    np.multiply(_ramp(len(out)), -rate, out=out)
+    np.exp(out, out=out)
+    out *= y0
+    return out
+
+
+class Envelope(object):
+    """
+    An amplitude curve over a note; ``render`` gives one amplitude per sample, which is what ``HToneFactory.render``
+    takes as ``ampl``.
+
+    Envelopes compare and hash by their parameters, so they can be passed to memoized methods directly.
+    """
+
+    def render(self, factory, beats, out=None):
+        """
+        :param out: an optional reusable buffer of at least ``factory.sample_count(beats)`` samples to fill
+        """
+        n = factory.sample_count(beats)
+        out = np.empty(n) if out is None else out[:n]
+        self.fill(out, factory, beats)
+        return out
+
+    def fill(self, out, factory, beats):
+        raise NotImplementedError(type(self))
+
+    def _cache_parts(self):
+        return tuple(sorted(vars(self).items()))
+
+    def __hash__(self):
+        return hash((type(self), self._cache_parts()))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._cache_parts() == other._cache_parts()
+
+
+class LinearDecay(Envelope):
+    """
+    The envelope of ``ToneFactory.get_linear_decay``: a 200 sample attack to ``ampl``, then a linear decay losing
+    ``strength`` of it (over two beats for notes longer than .4 beats), and a further decay to the end of the note.
+    Strengths over 1 cut the note short, leaving silence for the rest of it.
+    """
+    attack = 200
+
+    def __init__(self, ampl=1.0, strength=1.0):
+        self.ampl = ampl
+        self.strength = strength
+
+    def fill(self, out, factory, beats):
+        ampl, strength = self.ampl, self.strength
+        length = len(out)
+        if strength > 1.0:
+            length = int(1. / strength * length)
+            out[length:] = 0
+            strength = 1.0
+        if beats > .4:
+            intermediate = int(factory.tempo * factory.framerate * 2)
+            end = (ampl * (1 - strength)) ** (beats / .4)
+        else:
+            intermediate = None
+            end = ampl * (1 - strength)
+
+        points = [(0, 0.), (self.attack, ampl)]
+        if intermediate is not None and self.attack < intermediate < length - 1:
+            points.append((intermediate, ampl * (1 - strength)))
+        points.append((length - 1, end))
+        points = [(x, y) for x, y in points if x <= length - 1]
+        for (x0, y0), (x1, y1) in zip(points, points[1:]):
+            linear_segment(out[x0:x1], y0, y1)
+        if length:
+            out[points[-1][0]] = points[-1][1]
+        return out
+
+
+class ADSR(Envelope):
+    """
+    Attack, decay, sustain, release, with times in seconds. The release is fitted inside the note, starting
+    ``release`` seconds before its end.
+    """
+
+    def __init__(self, attack=.01, decay=.1, sustain=.7, release=.1, ampl=1.0):
+        self.attack = attack
+        self.decay = decay
+        self.sustain = sustain
+        self.release = release
+        self.ampl = ampl
+
+    def fill(self, out, factory, beats):
+        n = len(out)
+        a = min(int(self.attack * factory.framerate), n)
+        d = min(int(self.decay * factory.framerate), n - a)
+        r = min(int(self.release * factory.framerate), n - a - d)
+        level = self.ampl * self.sustain
+        linear_segment(out[:a], 0., self.ampl)
+        linear_segment(out[a:a + d], self.ampl, level)
+        out[a + d:n - r] = level
+        linear_segment(out[n - r:], level, 0.)
+        return out
+
+
+class ExponentialDecay(Envelope):
+    """
+    A linear attack of ``attack`` samples to ``ampl``, then exponential decay halving every ``half_life`` seconds.
+    """
+
+    def __init__(self, ampl=1.0, half_life=.5, attack=200):
+        self.ampl = ampl
+        self.half_life = half_life
+        self.attack = attack
+
+    def fill(self, out, factory, beats):
+        a = min(self.attack, len(out))
+        linear_segment(out[:a], 0., self.ampl)
+        exponential_segment(out[a:], self.ampl, np.log(2) / (self.half_life * factory.framerate))
+        return out
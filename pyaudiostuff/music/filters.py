@@ -0,0 +1,260 @@
+import copy
+
+import numpy as np
+
+from utils import lazy
+
+pd = lazy.lazy_import('pandas')
+
+
+class Filter(object):
+    """
+    A DSP stage that processes blocks of samples in place, carrying its state from one block to the next, so a
+    tone can be filtered whole or as a stream (``render.stream_line(filters=...)``, ``synth.Synth(filters=...)``).
+
+    Filters also work as ``render(filters=...)`` callables: ``filter(tone, freq, ampl, beats)`` runs a fresh copy of
+    the stage over the whole tone and returns the result. They compare and hash by their parameters (public
+    attributes); state lives in underscored ones.
+    """
+
+    def process(self, block):
+        """
+        Filters ``block`` (a float64 array) in place.
+
+        :return: block
+        """
+        raise NotImplementedError(type(self))
+
+    def reset(self):
+        """
+        Forgets everything seen so far.
+        """
+
+    def __call__(self, tone, *_):
+        stage = copy.deepcopy(self)
+        stage.reset()
+        out = stage.process(np.array(tone, np.float64))
+        return pd.Series(out, tone.index) if lazy.isinstance_of(tone, 'pandas', 'Series') else out
+
+    def _scratch(self, n):
+        scratch = getattr(self, '_scratch_buffer', None)
+        if scratch is None or len(scratch) < n:
+            scratch = self._scratch_buffer = np.empty(n)
+        return scratch[:n]
+
+    def _cache_parts(self):
+        return tuple(sorted((k, v) for k, v in vars(self).items() if not k.startswith('_')))
+
+    def __hash__(self):
+        return hash((type(self), self._cache_parts()))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._cache_parts() == other._cache_parts()
+
+
+class FilterChain(Filter):
+    def __init__(self, *stages):
+        self.stages = tuple(stages)
+
+    def process(self, block):
+        for stage in self.stages:
+            stage.process(block)
+        return block
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+
+class Harsher(Filter):
+    """
+    Compresses towards the average level: ``sqrt(level * |x|) * sign(x)``, where the level is the mean of ``|x|``
+    over everything processed so far (this block included). Over a whole tone that is the tone's mean, as in
+    ``tone.harsher``.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._total = 0.
+        self._count = 0
+
+    def process(self, block):
+        magnitude = self._scratch(len(block))
+        np.abs(block, out=magnitude)
+        self._total += magnitude.sum()
+        self._count += len(block)
+        if self._count:
+            magnitude *= self._total / self._count
+        np.sqrt(magnitude, out=magnitude)
+        np.copysign(magnitude, block, out=block)
+        return block
+
+
+class LinearFilter(Filter):
+    """
+    A recursive filter with transfer function coefficients ``b``, ``a``:
+    ``y[n] = sum(b[k] * x[n - k]) - sum(a[k] * y[n - k] for k >= 1)``, with ``a[0] == 1``.
+
+    The recurrence runs ``block_size`` samples at a time as two matrix products: one of the sub-block's input with
+    the filter's impulse response, and one of the previous inputs and outputs with their response. That is exact
+    (not an approximation), vectorized, and writes through preallocated buffers, so processing allocates nothing
+    per block (and needs no scipy) once the first block has been seen.
+    """
+    block_size = 64
+
+    def coefficients(self):
+        raise NotImplementedError(type(self))
+
+    def reset(self):
+        state = getattr(self, '_state', None)
+        if state is not None:
+            state[:] = 0
+
+    def _prepare(self):
+        b, a = self.coefficients()
+        order = max(len(a), len(b)) - 1
+        b = np.concatenate((b, np.zeros(order + 1 - len(b))))
+        a = np.concatenate((a, np.zeros(order + 1 - len(a))))
+        size = self.block_size
+
+        def run(x, state):
+            # The plain recurrence, only used to tabulate responses.
+            xs, ys = list(state[:order]), list(state[order:])
+            out = []
+            for value in x:
+                xs.insert(0, value)
+                y = sum(b[k] * xs[k] for k in range(order + 1)) - sum(a[k] * ys[k - 1] for k in range(1, order + 1))
+                ys.insert(0, y)
+                out.append(y)
+            return out
+
+        impulse = run([1.] + [0.] * (size - 1), [0.] * 2 * order)
+        response = np.zeros((size, size))
+        for i in range(size):
+            response[i:, i] = impulse[:size - i]
+        carry = np.empty((size, 2 * order))
+        for j in range(2 * order):
+            unit = [0.] * 2 * order
+            unit[j] = 1.
+            carry[:, j] = run([0.] * size, unit)
+        self._order = order
+        self._response = response
+        self._carry = carry
+        self._state = np.zeros(2 * order)  # x[n - 1], ..., x[n - order], y[n - 1], ..., y[n - order]
+        self._input = np.empty(size)
+        self._carried = np.empty(size)
+
+    def process(self, block):
+        if getattr(self, '_response', None) is None:
+            self._prepare()
+        order, state, size = self._order, self._state, self.block_size
+        for start in range(0, len(block), size):
+            out = block[start:start + size]
+            n = len(out)
+            x = self._input[:n]
+            x[:] = out
+            np.matmul(self._response[:n, :n], x, out=out)
+            np.matmul(self._carry[:n], state, out=self._carried[:n])
+            out += self._carried[:n]
+            for history, new in ((state[:order], x), (state[order:], out)):
+                for k in range(order - 1, n - 1, -1):  # only when the block is shorter than the order
+                    history[k] = history[k - n]
+                history[:min(n, order)] = new[::-1][:order]
+        return block
+
+
+class OnePoleLowPass(LinearFilter):
+    """
+    ``y[n] = y[n-1] + k * (x[n] - y[n-1])``, with ``k`` set by the -3dB ``cutoff`` in Hz.
+    """
+
+    def __init__(self, cutoff, framerate):
+        self.cutoff = cutoff
+        self.framerate = framerate
+        self.reset()
+
+    def coefficients(self):
+        pole = np.exp(-2 * np.pi * self.cutoff / self.framerate)
+        return np.array([1 - pole]), np.array([1, -pole])
+
+
+class OnePoleHighPass(OnePoleLowPass):
+    """
+    The complement of ``OnePoleLowPass``: ``x - lowpass(x)``.
+    """
+
+    def coefficients(self):
+        pole = np.exp(-2 * np.pi * self.cutoff / self.framerate)
+        return np.array([pole, -pole]), np.array([1, -pole])
+
+
+class Biquad(LinearFilter):
+    """
+    A second order section from the RBJ audio EQ cookbook.
+
+    :param kind: 'lowpass', 'highpass', 'bandpass', 'notch', 'peak', 'lowshelf' or 'highshelf'
+    :param freq: the centre or corner frequency in Hz
+    :param gain_db: boost (or cut) for 'peak' and the shelves
+    """
+    kinds = ('lowpass', 'highpass', 'bandpass', 'notch', 'peak', 'lowshelf', 'highshelf')
+
+    def __init__(self, kind, freq, framerate, q=.7071, gain_db=0.):
+        if kind not in self.kinds:
+            raise ValueError('Unknown biquad {!r}; expected one of {}'.format(kind, self.kinds))
+        self.kind = kind
+        self.freq = freq
+        self.framerate = framerate
+        self.q = q
+        self.gain_db = gain_db
+        self.reset()
+
+    def coefficients(self):
+        w = 2 * np.pi * self.freq / self.framerate
+        cos, alpha = np.cos(w), np.sin(w) / (2 * self.q)
+        g = 10 ** (self.gain_db / 40)
+        kind = self.kind
+        if kind == 'lowpass':
+            b = [(1 - cos) / 2, 1 - cos, (1 - cos) / 2]
+            a = [1 + alpha, -2 * cos, 1 - alpha]
+        elif kind == 'highpass':
+            b = [(1 + cos) / 2, -(1 + cos), (1 + cos) / 2]
+            a = [1 + alpha, -2 * cos, 1 - alpha]
+        elif kind == 'bandpass':
+            b = [alpha, 0, -alpha]
+            a = [1 + alpha, -2 * cos, 1 - alpha]
+        elif kind == 'notch':
+            b = [1, -2 * cos, 1]
+            a = [1 + alpha, -2 * cos, 1 - alpha]
+        elif kind == 'peak':
+            b = [1 + alpha * g, -2 * cos, 1 - alpha * g]
+            a = [1 + alpha / g, -2 * cos, 1 - alpha / g]
+        else:
+            sign = 1 if kind == 'lowshelf' else -1
+            root = 2 * np.sqrt(g) * alpha
+            b = [g * ((g + 1) - sign * (g - 1) * cos + root),
+                 sign * 2 * g * ((g - 1) - sign * (g + 1) * cos),
+                 g * ((g + 1) - sign * (g - 1) * cos - root)]
+            a = [(g + 1) + sign * (g - 1) * cos + root,
+                 -sign * 2 * ((g - 1) + sign * (g + 1) * cos),
+                 (g + 1) + sign * (g - 1) * cos - root]
+        b, a = np.array(b, np.float64), np.array(a, np.float64)
+        return b / a[0], a / a[0]
+
+
+class SoftClip(Filter):
+    """
+    ``limit * tanh(drive * x / limit)``, the 'soft' mode of ``tone.mix_into`` with a drive. ``limit`` is in sample
+    units, e.g. ``factory._width`` for rendered tones.
+    """
+
+    def __init__(self, limit=1.0, drive=1.0):
+        self.limit = limit
+        self.drive = drive
+
+    def process(self, block):
+        block *= self.drive / self.limit
+        np.tanh(block, out=block)
+        block *= self.limit
+        return block
@@ -1,10 +1,19 @@
-import alsaseq
+import argparse
+import asyncio
+import collections
+import queue
+import threading
 import time
-import pandas as pd
+import traceback
+import numpy as np
 import pydantic
 
+from utils import lazy
 from utils.decorator import memoize
 
+alsaseq = lazy.lazy_import('alsaseq')
+pd = lazy.lazy_import('pandas')
+
 MIDI_OFFSET = 20
 
 
@@ -22,6 +31,124 @@ class RawMidiNote(pydantic.BaseModel):
     end: float = None
 
 
+def _column(name, cast):
+    def fget(self):
+        return cast(self.log.column(name, full=True)[self.index])
+
+    def fset(self, value):
+        self.log.column(name, full=True)[self.index] = value
+
+    return property(fget, fset)
+
+
+def _optional_float(value):
+    return None if np.isnan(value) else float(value)
+
+
+class NoteView(object):
+    """
+    A ``RawMidiNote``-compatible view of one row of a ``NoteLog``; setting an attribute writes through to the log.
+    """
+    __slots__ = ('log', 'index')
+
+    def __init__(self, log, index):
+        self.log = log
+        self.index = index
+
+    start = _column('start', float)
+    end = _column('end', _optional_float)
+    piano_key = _column('piano_key', int)
+    velocity = _column('velocity', int)
+    dampened = _column('dampened', bool)
+
+    def to_raw(self):
+        return RawMidiNote(start=self.start, piano_key=self.piano_key, velocity=self.velocity,
+                           dampened=self.dampened, end=self.end)
+
+    def __repr__(self):
+        return 'NoteView(start={}, piano_key={}, velocity={}, dampened={}, end={})'.format(
+            self.start, self.piano_key, self.velocity, self.dampened, self.end)
+
+
+class NoteLog(object):
+    """
+    An append-only, columnar log of notes held in growable NumPy arrays.
+
+    Appends are amortized O(1) (capacity doubles when full). Indexing gives ``NoteView``s that behave like
+    ``RawMidiNote``s, while ``start``, ``end``, ``piano_key``, ``velocity`` and ``dampened`` give the columns as
+    array views, which are only guaranteed to reflect later writes until the log next grows.
+    """
+    fields = (
+        ('start', np.float64),
+        ('end', np.float64),
+        ('piano_key', np.int16),
+        ('velocity', np.int16),
+        ('dampened', np.bool_),
+    )
+
+    def __init__(self, capacity=1024):
+        self._size = 0
+        self._columns = {name: np.empty(max(capacity, 1), dtype) for name, dtype in self.fields}
+
+    def __len__(self):
+        return self._size
+
+    def column(self, name, full=False):
+        col = self._columns[name]
+        return col if full else col[:self._size]
+
+    start = property(lambda self: self.column('start'))
+    end = property(lambda self: self.column('end'))
+    piano_key = property(lambda self: self.column('piano_key'))
+    velocity = property(lambda self: self.column('velocity'))
+    dampened = property(lambda self: self.column('dampened'))
+
+    def append(self, start, piano_key, velocity, dampened=False, end=None):
+        """
+        :return: a ``NoteView`` of the new note
+        """
+        if self._size == len(self._columns['start']):
+            for name, col in self._columns.items():
+                grown = np.empty(2 * len(col), col.dtype)
+                grown[:self._size] = col[:self._size]
+                self._columns[name] = grown
+        i = self._size
+        self._columns['start'][i] = start
+        self._columns['end'][i] = np.nan if end is None else end
+        self._columns['piano_key'][i] = piano_key
+        self._columns['velocity'][i] = velocity
+        self._columns['dampened'][i] = dampened
+        self._size += 1
+        return NoteView(self, i)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [NoteView(self, i) for i in range(*item.indices(self._size))]
+        if item < 0:
+            item += self._size
+        if not 0 <= item < self._size:
+            raise IndexError(item)
+        return NoteView(self, item)
+
+    def __iter__(self):
+        return (NoteView(self, i) for i in range(self._size))
+
+    def series(self, name):
+        """
+        A pd.Series backed by (not copied from) one column.
+        """
+        return pd.Series(self.column(name), name=name, copy=False)
+
+    def to_frame(self):
+        return pd.DataFrame({name: self.series(name) for name, _ in self.fields}, copy=False)
+
+    def freqs(self, tuning):
+        """
+        The frequency of every note, looked up in a ``constants.WesternTuning`` in one go.
+        """
+        return tuning.freqs_from_midi(self.piano_key + MIDI_OFFSET)
+
+
 NOTE_PLAYED = 6
 PEDAL_PRESSED = 10
 HEARTBEAT = 42
@@ -31,10 +158,61 @@ MIDDLE_PEDAL = 66
 DAMPEN_PEDAL = 67
 
 
-class LiveListener(object):
+class AlsaEventSource(object):
     def __init__(self, connection_id=20):
         start_client(connection_id)
-        self.notes = []  # type:list[RawMidiNote]
+
+    def read(self):
+        """
+        Blocks (without spinning) until the next event arrives.
+        """
+        return alsaseq.input()
+
+
+class FakeEventSource(object):
+    """
+    An in-process stand-in for ``AlsaEventSource``, for running a ``LiveListener`` without ALSA hardware.
+
+    Events are tuples in alsaseq's layout; ``note`` and ``pedal`` build them. ``read`` blocks until an event is
+    pushed and returns ``None`` once the source is closed.
+    """
+
+    def __init__(self, events=()):
+        self._queue = queue.Queue()
+        for event in events:
+            self.push(event)
+
+    @staticmethod
+    def note(midi_key, velocity):
+        return NOTE_PLAYED, 0, 0, 253, (0, 0), (0, 0), (0, 0), (0, midi_key, velocity, 0, 0)
+
+    @staticmethod
+    def pedal(pedal, depressed):
+        return PEDAL_PRESSED, 0, 0, 253, (0, 0), (0, 0), (0, 0), (0, 0, 0, 0, pedal, depressed)
+
+    def push(self, event):
+        self._queue.put(event)
+
+    def close(self):
+        self._queue.put(None)
+
+    def read(self):
+        return self._queue.get()
+
+
+class LiveListener(object):
+    def __init__(self, connection_id=20, sinks=(), source=None):
+        """
+        :param sinks: objects (such as ``synth.Synth``) notified of every key and pedal event, through
+            ``note_on(key, velocity)``, ``note_off(key)``, ``sustain_pedal(depressed)``,
+            ``sostenuto_pedal(depressed)`` and ``soft_pedal(depressed)``
+        :param source: where events are read from; defaults to the ALSA sequencer
+        """
+        self.source = AlsaEventSource(connection_id) if source is None else source
+        self.sinks = list(sinks)
+        self._subscribers = {}
+        self._thread = None
+        self.notes = NoteLog()
         self.pedal_events = []
         self.dampened = False
         self.sounding_notes = {}
@@ -43,26 +221,86 @@ class LiveListener(object):
         self.sustain = False
 
     def listen(self):
-        while True:
-            try:
-                if alsaseq.inputpending():
-                    self.process_event(alsaseq.input())
-            except KeyboardInterrupt:
-                break
+        """
+        Processes events on this thread until interrupted or the source runs out.
+        """
+        try:
+            while True:
+                try:
+                    event = self.source.read()
+                except KeyboardInterrupt:
+                    break
+                if event is None:
+                    break
+                try:
+                    self.process_event(event)
+                except Exception:
+                    # One bad event (or sink) must not end listening for every other sink.
+                    traceback.print_exc()
+        finally:
+            self._publish(None)
+
+    def start(self):
+        """
+        Listens on a daemon thread; see ``subscribe`` and ``events`` for consuming events from other threads.
+        """
+        self._thread = threading.Thread(target=self.listen, name='LiveListener', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def subscribe(self, maxsize=0):
+        """
+        :return: a queue.Queue that receives every event processed from now on, then ``None`` when listening stops
+        """
+        q = queue.Queue(maxsize)
+        self._subscribers = {**self._subscribers, id(q): q.put}
+        return q
+
+    def unsubscribe(self, q):
+        self._subscribers = {k: v for k, v in self._subscribers.items() if k != id(q)}
+
+    async def events(self):
+        """
+        Iterates over events from the running event loop: ``async for event in listener.events()``.
+        """
+        loop = asyncio.get_running_loop()
+        q = asyncio.Queue()
+        token = object()
+        put = lambda e: loop.call_soon_threadsafe(q.put_nowait, e)
+        self._subscribers = {**self._subscribers, id(token): put}
+        try:
+            while True:
+                event = await q.get()
+                if event is None:
+                    break
+                yield event
+        finally:
+            self.unsubscribe(token)
+
+    def _publish(self, event):
+        for put in self._subscribers.values():
+            put(event)
 
     def process_event(self, event):
+        self._publish(event)
         typ = event[0]
         if typ == NOTE_PLAYED:
             _, midi_key, velocity, __, ___ = event[-1]
             key = midi_key - MIDI_OFFSET
+            for sink in self.sinks:
+                if velocity == 0:
+                    sink.note_off(key)
+                else:
+                    sink.note_on(key, velocity)
             if velocity == 0:
-                note = self.sounding_notes.pop(key)
+                # No note-on for keys already held when listening started, or for repeated note-offs.
+                note = self.sounding_notes.pop(key, None)
+                if note is None:
+                    return
                 note.end = time.time()
             else:
-                note = RawMidiNote(start=time.time(), piano_key=key, velocity=velocity, dampened=self.dampened)
-                print(note)
+                note = self.notes.append(time.time(), key, velocity, self.dampened)
                 self.sounding_notes[key] = note
-                self.notes.append(note)
                 if self.sustain:
                     self.sustained_notes[key] = note
                 if key in self.mid_sustained_notes:
@@ -70,6 +308,13 @@ class LiveListener(object):
         elif typ == PEDAL_PRESSED:
             pedal, depressed = event[-1][-2:]
             self.pedal_events.append((pedal, depressed, time.time()))
+            for sink in self.sinks:
+                if pedal == DAMPEN_PEDAL:
+                    sink.soft_pedal(depressed)
+                elif pedal == MIDDLE_PEDAL:
+                    sink.sostenuto_pedal(depressed)
+                elif pedal == SUSTAIN_PEDAL:
+                    sink.sustain_pedal(depressed)
             if pedal == DAMPEN_PEDAL:
                 self.dampened = bool(depressed)
             elif pedal == MIDDLE_PEDAL:
@@ -97,16 +342,65 @@ class Chord(object):
         self.notes.append(note)
 
 
-def group_chords(notes, threshold=.02):
-    chord = Chord(notes[0])
-    chords = [chord]
+def _note_columns(notes):
+    if isinstance(notes, NoteLog):
+        return notes.start, notes.end
+    starts = np.array([note.start for note in notes], np.float64)
+    ends = np.array([np.nan if note.end is None else note.end for note in notes], np.float64)
+    return starts, ends
 
-    for note in notes[1:]:
-        if (note.start - chord.start) < threshold:
-            chord.add_note(note)
-        else:
-            chord = Chord(note)
-            chords.append(chord)
+
+def chord_boundaries(starts, threshold=.02):
+    """
+    The indices at which chords begin among sorted note start times.
+
+    A note joins the current chord while it starts less than ``threshold`` after the chord's first note (as in
+    ``group_chords``). Any gap of at least ``threshold`` must start a chord and any run of notes spanning less than
+    ``threshold`` must be one chord, so only runs spanning longer than that are split one chord at a time.
+    """
+    starts = np.asarray(starts, np.float64)
+    if not len(starts):
+        return np.empty(0, np.intp)
+    gaps = np.flatnonzero(np.diff(starts) >= threshold) + 1
+    runs = np.concatenate(([0], gaps))
+    run_ends = np.concatenate((gaps, [len(starts)]))
+    extra = []
+    long_runs = np.flatnonzero(starts[run_ends - 1] - starts[runs] >= threshold)
+    for begin, stop in zip(runs[long_runs], run_ends[long_runs]):
+        i = begin
+        while True:
+            j = begin + np.searchsorted(starts[begin:stop], starts[i] + threshold)
+            # Settle rounding at the edge the same way group_chords compares: start - chord start < threshold.
+            while j > i + 1 and starts[j - 1] - starts[i] >= threshold:
+                j -= 1
+            while j < stop and starts[j] - starts[i] < threshold:
+                j += 1
+            if j >= stop:
+                break
+            extra.append(j)
+            i = j
+    return np.union1d(runs, np.array(extra, np.intp)) if extra else runs
+
+
+def group_chord_arrays(starts, ends, threshold=.02):
+    """
+    :return: (chord start times, chord end times, index of each chord's first note)
+    """
+    bounds = chord_boundaries(starts, threshold)
+    if not len(bounds):
+        return np.empty(0), np.empty(0), bounds
+    return np.asarray(starts, np.float64)[bounds], np.fmax.reduceat(np.asarray(ends, np.float64), bounds), bounds
+
+
+def group_chords(notes, threshold=.02):
+    starts, ends = _note_columns(notes)
+    _, chord_ends, bounds = group_chord_arrays(starts, ends, threshold)
+    chords = []
+    for begin, stop, end in zip(bounds, np.append(bounds[1:], len(starts)), chord_ends):
+        chord = Chord(notes[begin])
+        chord.notes = list(notes[begin:stop])
+        chord.end = None if np.isnan(end) else float(end)
+        chords.append(chord)
 
     return chords
 
@@ -120,39 +414,132 @@ def infer_rhythm(chords, hint=.02, var=.20, most_common=1, sequence=(1, 2, 3, 4,
     :param sequence: a list of the valid denominators of fractions of a single beat
     :return:
     """
+    return infer_rhythm_array(np.array([chord.start for chord in chords], np.float64), hint=hint, var=var,
+                              most_common=most_common, sequence=sequence)
+
+
+def infer_rhythm_array(starts, hint=.02, var=.20, most_common=1, sequence=(1, 2, 3, 4, 8)):
+    """
+    ``infer_rhythm`` over an array of sorted chord start times, with every denominator in ``sequence`` tried in
+    one broadcast. Where several fit, the earliest in ``sequence`` wins.
+    """
     mult = int(1/hint)
-    last = chords[0]
-    differences = []
-    raw_diffs = []
-    for chord in chords[1:]:
-        raw = chord.start - last.start
-        differences.append(int(mult * raw))
-        raw_diffs.append(raw)
-        last = chord
-    counts = pd.Series(differences).value_counts()
-    if len(counts) == len(raw_diffs):
+    raw = np.diff(np.asarray(starts, np.float64))
+    values, first, counts = np.unique((mult * raw).astype(np.int64), return_index=True, return_counts=True)
+    if len(values) == len(raw):
         raise ValueError('Hint ({}) is too tight or not enough chords to infer rhythm'.format(hint))
-    mode = hint * counts.idxmax()
-    raw = pd.Series(raw_diffs)
-    best_guess = raw[((1 - var) * mode < raw) & (raw < (1 + var) * mode)].mean()
-    best_guess = best_guess/most_common
-    denoms = pd.Series(pd.np.nan, range(len(raw)))
-    for i in reversed(sequence):
-        s = (i * raw / best_guess)  # type: pd.Series
-        r = s.round()
-        valid = (s - r).abs() < var
-        denoms[valid] = i
-
-    nums = (denoms * raw/best_guess).round()
+    # Like value_counts().idxmax(), break ties in favour of the value seen first.
+    mode = hint * values[np.where(counts == counts.max(), first, len(raw)).argmin()]
+    near = raw[((1 - var) * mode < raw) & (raw < (1 + var) * mode)]
+    # An empty window (e.g. a mode of 0) leaves no beat to measure by; NaN, like the pandas mean, without a warning.
+    best_guess = near.mean() / most_common if len(near) else np.nan
+
+    beats = raw / best_guess
+    candidates = np.asarray(sequence, np.float64)
+    s = np.multiply.outer(candidates, beats)
+    valid = np.abs(s - s.round()) < var
+    denoms = np.where(valid.any(axis=0), candidates[valid.argmax(axis=0)], np.nan)
+    nums = (denoms * beats).round()
 
     return pd.DataFrame(dict(nums=nums, denoms=denoms, raw=raw, bg=best_guess))
 
 
+Quantized = collections.namedtuple('Quantized', ['num', 'denom', 'raw', 'best_guess'])
+
+
+class RhythmTracker(object):
+    """
+    An online ``group_chords`` + ``infer_rhythm``: notes or chords are fed in one at a time as they are played, and
+    each new chord gets a num/denom quantization of the interval since the previous chord.
+
+    Inter-onset intervals go into a histogram of ``hint``-wide bins that also keeps each bin's sum, so the mode and
+    the mean of the intervals near it (the beat estimate) are updated without rescanning history. The window
+    around the mode is taken a whole bin at a time, so intervals right at its edges may count slightly differently
+    than in ``infer_rhythm``.
+
+    Can be added to a ``LiveListener``'s sinks, in which case note-ons are timed as they arrive.
+    """
+
+    def __init__(self, threshold=.02, hint=.02, var=.20, most_common=1, sequence=(1, 2, 3, 4, 8)):
+        self.threshold = threshold
+        self.hint = hint
+        self.var = var
+        self.most_common = most_common
+        self.sequence = sequence
+        self.mult = int(1/hint)
+        self.counts = collections.defaultdict(int)
+        self.sums = collections.defaultdict(float)
+        self.mode = None
+        self.best_guess = None
+        self.chord_start = None
+        self.latest = None
+
+    def add_note(self, start):
+        """
+        :return: a ``Quantized`` if ``start`` begins a new chord and there is enough history for a beat estimate
+        """
+        if self.chord_start is not None and start - self.chord_start < self.threshold:
+            return None
+        return self.add_chord_start(start)
+
+    def add_chord(self, chord):
+        return self.add_chord_start(chord.start)
+
+    def add_chord_start(self, start):
+        last, self.chord_start = self.chord_start, start
+        if last is None:
+            return None
+        return self.add_interval(start - last)
+
+    def add_interval(self, raw):
+        b = int(self.mult * raw)
+        self.counts[b] += 1
+        self.sums[b] += raw
+        if self.mode is None or self.counts[b] > self.counts[self.mode]:
+            self.mode = b
+        if self.counts[self.mode] < 2:
+            return None  # Every interval so far is unique; infer_rhythm would refuse too.
+        mode = self.hint * self.mode
+        low, high = int(self.mult * (1 - self.var) * mode), int(self.mult * (1 + self.var) * mode)
+        total = sum(self.sums[i] for i in range(low, high + 1) if i in self.sums)
+        count = sum(self.counts[i] for i in range(low, high + 1) if i in self.counts)
+        self.best_guess = total / count / self.most_common
+        self.latest = self.quantize(raw)
+        return self.latest
+
+    def quantize(self, raw):
+        beats = raw / self.best_guess
+        for denom in self.sequence:
+            s = denom * beats
+            if abs(s - round(s)) < self.var:
+                return Quantized(round(s), denom, raw, self.best_guess)
+        return Quantized(None, None, raw, self.best_guess)
+
+    def note_on(self, key, velocity):
+        self.add_note(time.time())
+
+    def note_off(self, key):
+        pass
+
+    def sustain_pedal(self, depressed):
+        pass
+
+    def sostenuto_pedal(self, depressed):
+        pass
+
+    def soft_pedal(self, depressed):
+        pass
+
 
-l = LiveListener()
-l.listen()
-last = 0
-print([n.piano_key for n in l.notes])
-print(infer_rhythm(group_chords(l.notes)))
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Records from a MIDI keyboard until interrupted, then infers the rhythm.')
+    parser.add_argument('--connection-id', type=int, default=20, help='ALSA sequencer client to listen to')
+    args = parser.parse_args(argv)
+    listener = LiveListener(args.connection_id)
+    listener.listen()
+    print([n.piano_key for n in listener.notes])
+    print(infer_rhythm(group_chords(listener.notes)))
 
 
+if __name__ == '__main__':
+    main()
@@ -1,67 +1,118 @@
+import argparse
 import wave
 import time
-import pyaudio
 import numpy as np
-from scipy.io import wavfile
 
 from music import tone
 from music import constants
+from music import render
+from music import wav
+from utils import lazy
 
-SIZES = {1: np.uint8, 2: np.int16, 4: np.int32, 8: np.int64}
+pyaudio = lazy.lazy_import('pyaudio')
 
+SIZES = wav.SIZES
+CHUNK = 1024 * 64
 
-def test_case():
-    tones = []
-    harmonics = constants.Harmonics.inharmonic
+
+def test_case(cache_dir=None, tail=0., filename=None):
+    harmonics = dict(constants.Harmonics.inharmonic)
     harmonics.update(constants.Harmonics.inharmonic2)
     harmonics.update(constants.Harmonics.inharmonic3)
     harmonics.update(constants.Harmonics.exp_decayed)
-    f = tone.HToneFactory(2, 22050, 1, harmonics=harmonics)
-    print('concatting notes')
-    for note in tone.melody.notes:
-        beats = note.duration * .25 / note.denom
-        a = .3 + .08 * beats
-        ampl = f.get_linear_decay(beats, a, .8)
-        print(note.freq, beats, a)
-        tone_ = f.render(note.freq, ampl, beats, )
-        tones.append(tone_)
-    song = np.concatenate(tones)
-    print(len(song))
-    play(f, song)
+    f = tone.HToneFactory(2, 22050, 1, harmonics=harmonics, cache_dir=cache_dir)
+    notes = render.stream_line(f, tone.melody, tail=tail)
+    if filename is not None:
+        write_wave(f, notes, filename)
+    else:
+        print('streaming notes')
+        play(f, notes)
+
+
+def play(tone_factory, notes, chunk=CHUNK, dither=True):
+    play_samples(notes, tone_factory.width, tone_factory.framerate, chunk=chunk, dither=dither)
+
+
+def write_wave(tone_factory, notes, filename, dither=True, nframes=None):
+    """
+    Writes ``notes`` (one buffer or an iterable of blocks, e.g. from ``render.stream_line``) to a WAV file,
+    quantizing block by block.
+
+    :param nframes: the total length, if known, to write through a memory map instead
+    """
+    return wav.write_blocks(filename, tone_factory.framerate, tone_factory.width, notes,
+                            dither=dither, nframes=nframes)
 
 
-def play(tone_factory, notes):
-    fn = "placeholder.wav"
-    write_wave(tone_factory, notes, fn)
-    play_wav(fn)
+def iter_sample_frames(samples, width, chunk=CHUNK, dither=True):
+    """
+    Yields PCM frames for ``samples``, which may be one in-memory buffer or an iterable of buffers.
 
+    Buffers are quantized with ``wav.quantize`` (clipped, so overlapping notes saturate rather than wrap, and
+    dithered like ``write_wave``) ``chunk`` frames at a time, so only one chunk is ever copied.
+    """
+    if isinstance(samples, np.ndarray) or hasattr(samples, 'to_numpy'):
+        buffer = samples
+        samples = (buffer[i:i + chunk] for i in range(0, len(buffer), chunk))
+    rng = np.random.default_rng() if dither else None
+    for block in samples:
+        yield wav.quantize(block, width, dither, rng).tobytes()
 
-def write_wave(tone_factory, notes, filename):
-    notes = np.array(notes, SIZES[tone_factory.width])
-    wavfile.write(filename, tone_factory.framerate, notes)
 
+def iter_wav_frames(f, chunk=CHUNK):
+    """
+    :type f: wave.Wave_read
+    """
+    while True:
+        data = f.readframes(chunk)
+        if not data:
+            break
+        yield data
 
-def play_wav(filename):
-    chunk = 1024 * 64
 
-    f = wave.open(filename, "rb")
+def play_frames(frames, width, framerate, channels=1):
+    """
+    Plays an iterable of PCM frames as they are produced.
+    """
     p = pyaudio.PyAudio()
-    print("width", f.getsampwidth())
-    nframes = f.getnframes()
-    print("frames", f.getframerate())
-    stream = p.open(format=p.get_format_from_width(f.getsampwidth()),
-                    channels=f.getnchannels(),
-                    rate=f.getframerate(),
+    stream = p.open(format=p.get_format_from_width(width),
+                    channels=channels,
+                    rate=framerate,
                     output=True)
-    data = f.readframes(nframes)
     start = time.time()
-    stream.write(data)
-
-    stream.stop_stream()
-    stream.close()
+    try:
+        for data in frames:
+            stream.write(data)
+        stream.stop_stream()
+    finally:
+        stream.close()
+        p.terminate()
     print(time.time() - start)
 
-    p.terminate()
+
+def play_samples(samples, width, framerate, chunk=CHUNK, dither=True):
+    play_frames(iter_sample_frames(samples, width, chunk, dither), width, framerate)
+
+
+def play_wav(filename, chunk=CHUNK):
+    with wave.open(filename, "rb") as f:
+        print("width", f.getsampwidth())
+        print("frames", f.getframerate())
+        play_frames(iter_wav_frames(f, chunk), f.getsampwidth(), f.getframerate(), f.getnchannels())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Plays the test melody, or a WAV file.')
+    parser.add_argument('wav', nargs='?', help='a WAV file to play instead of the melody')
+    parser.add_argument('--write', metavar='FILENAME', help='write the melody to a WAV file instead of playing it')
+    parser.add_argument('--cache-dir', help='directory for persisting rendered notes between runs')
+    parser.add_argument('--tail', type=float, default=0., help='beats each note rings past its end')
+    args = parser.parse_args(argv)
+    if args.wav:
+        play_wav(args.wav)
+    else:
+        test_case(cache_dir=args.cache_dir, tail=args.tail, filename=args.write)
 
 
-test_case()
+if __name__ == '__main__':
+    main()
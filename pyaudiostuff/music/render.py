@@ -0,0 +1,225 @@
+import collections
+import concurrent.futures
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+BLOCK_SIZE = 4096
+
+NoteSpec = collections.namedtuple('NoteSpec', ['freq', 'duration', 'denom'])
+
+
+def note_beats(note):
+    return note.duration * .25 / note.denom
+
+
+def note_lengths(factory, line, notes=None):
+    """
+    The number of samples of each note, computed in one pass for lines with a ``beats`` column (``score.Score``).
+    """
+    beats = getattr(line, 'beats', None)
+    if beats is not None:
+        return (factory.tempo * beats * factory.framerate).astype(np.int64)
+    return [factory.sample_count(note_beats(note)) for note in (line.notes if notes is None else notes)]
+
+
+def render_note(factory, note, tail=0.):
+    """
+    Renders one note of a ``MusicLine`` the way ``player.test_case`` does.
+
+    :param tail: beats to keep sounding past the end of the note, fading linearly to silence
+    :return: (the number of samples before the next note starts, the rendered samples)
+    """
+    beats = note_beats(note)
+    ampl = factory.get_linear_decay(beats, .3 + .08 * beats, .8)
+    length = factory.sample_count(beats)
+    if not tail:
+        return length, factory.render(note.freq, ampl, beats)
+
+    # The tailed envelope is a fresh array, so render at unit amplitude (which memoizes by value) and apply it here.
+    total = factory.sample_count(beats + tail)
+    envelope = np.empty(total)
+    envelope[:length] = np.asarray(ampl, np.float64)[:length]
+    envelope[length:] = np.linspace(envelope[length - 1] if length else 0., 0., total - length)
+    return length, envelope * factory.render(note.freq, 1.0, beats + tail)
+
+
+class OverlapAdd(object):
+    """
+    Sums buffers that start at non-decreasing sample positions into a fixed-size ring buffer, handing back
+    ``block_size`` blocks as soon as no later buffer can overlap them.
+    """
+
+    def __init__(self, block_size, capacity):
+        if capacity < block_size:
+            raise ValueError('capacity ({}) must be at least block_size ({})'.format(capacity, block_size))
+        self.block_size = block_size
+        self.ring = np.zeros(capacity)
+        self.emitted = 0  # absolute position of the oldest sample still in the ring
+        self.final = 0  # samples before this position will not change any more
+        self.end = 0
+
+    def add(self, position, samples, length):
+        """
+        Adds ``samples`` starting at absolute sample ``position`` and yields the blocks that become final.
+
+        :param length: the samples after ``position + length`` are a tail that later buffers may overlap
+        """
+        if position < self.final:
+            raise ValueError('Buffers must be added in order of position')
+        capacity = len(self.ring)
+        written = 0
+        while written < len(samples):
+            room = self.emitted + capacity - (position + written)
+            if room <= 0:
+                if self.final - self.emitted < self.block_size:
+                    raise ValueError('Tail is longer than the ring buffer allows')
+                yield self._pop(self.block_size)
+                continue
+            piece = samples[written:written + room]
+            self._add(position + written, piece)
+            written += len(piece)
+            self.final = max(self.final, min(position + written, position + length))
+        self.final = max(self.final, position + length)
+        self.end = max(self.end, self.final, position + len(samples))
+        while self.final - self.emitted >= self.block_size:
+            yield self._pop(self.block_size)
+
+    def flush(self):
+        """
+        Yields everything that is left, the last block possibly short.
+        """
+        self.final = self.end
+        while self.emitted < self.final:
+            yield self._pop(min(self.block_size, self.final - self.emitted))
+
+    def _add(self, position, samples):
+        i = position % len(self.ring)
+        first = min(len(samples), len(self.ring) - i)
+        self.ring[i:i + first] += samples[:first]
+        self.ring[:len(samples) - first] += samples[first:]
+
+    def _pop(self, size):
+        i = self.emitted % len(self.ring)
+        first = min(size, len(self.ring) - i)
+        block = np.empty(size)
+        block[:first] = self.ring[i:i + first]
+        block[first:] = self.ring[:size - first]
+        self.ring[i:i + first] = 0
+        self.ring[:size - first] = 0
+        self.emitted += size
+        return block
+
+
+def stream_line(factory, line, block_size=BLOCK_SIZE, tail=0., filters=()):
+    """
+    Renders a ``MusicLine`` (or ``score.Score``) note by note, yielding ``block_size`` blocks of samples.
+
+    Only one note and a ring buffer of ``2 * block_size`` samples plus the tail are held at once, so memory stays
+    flat however long the line is. With ``tail=0`` the output matches concatenating the rendered notes.
+
+    :param filters: ``filters.Filter`` stages applied in order to each block of the mix (they are reset first)
+    """
+    for stage in filters:
+        stage.reset()
+    ola = OverlapAdd(block_size, 2 * block_size + factory.sample_count(tail))
+    position = 0
+    for note in line.notes:
+        length, samples = render_note(factory, note, tail)
+        for block in ola.add(position, samples, length):
+            yield _filter(block, filters)
+        position += length
+    for block in ola.flush():
+        yield _filter(block, filters)
+
+
+def _filter(block, filters):
+    for stage in filters:
+        stage.process(block)
+    return block
+
+
+def _render_chunk(factory, notes, offsets, out):
+    for note, offset in zip(notes, offsets):
+        length, samples = render_note(factory, note)
+        out[offset:offset + length] = samples[:length]
+
+
+# The factory a process-pool worker renders with, set once per worker by ``_init_worker``.
+_worker_factory = None
+
+
+def _init_worker(factory):
+    global _worker_factory
+    _worker_factory = factory
+
+
+def _render_chunk_shared(notes, offsets, target):
+    factory = _worker_factory
+    kind, name, total = target[:3]
+    if kind == 'memmap':
+        out = np.memmap(name, np.float64, 'r+', offset=target[3], shape=(total, ))
+        _render_chunk(factory, notes, offsets, out)
+        out.flush()
+    else:
+        shm = shared_memory.SharedMemory(name)
+        try:
+            _render_chunk(factory, notes, offsets, np.ndarray((total, ), np.float64, shm.buf))
+        finally:
+            shm.close()
+
+
+def render_line_parallel(factory, line, workers=None, processes=False, chunk=4, out=None):
+    """
+    Renders the notes of a ``MusicLine`` (or ``score.Score``) concurrently, ``chunk`` notes per task, into one buffer in order.
+
+    Note offsets are known up front, so every worker writes its notes straight into place. With threads (the
+    default; the NumPy kernels release the GIL) that is ``out`` itself. With ``processes=True`` each worker is sent
+    one pickled copy of the factory, without its in-memory caches, as it starts; tasks then carry only note specs,
+    and workers write into shared memory, or into ``out`` directly when it is an ``np.memmap``, so no rendered
+    samples are pickled.
+
+    :param out: optional float64 buffer (or memmap) of at least the total number of samples
+    :return: the rendered line, equal to concatenating ``render_note`` over its notes
+    """
+    notes = list(line.notes)
+    lengths = note_lengths(factory, line, notes)
+    offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+    total = int(offsets[-1])
+    if out is None and not processes:
+        out = np.empty(total)
+    tasks = [(notes[i:i + chunk], offsets[i:i + chunk]) for i in range(0, len(notes), chunk)]
+    workers = workers or os.cpu_count()
+
+    if not processes:
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            for future in [executor.submit(_render_chunk, factory, n, o, out) for n, o in tasks]:
+                future.result()
+        return out[:total]
+
+    shm = None
+    if isinstance(out, np.memmap):
+        target = ('memmap', out.filename, total, out.offset)
+    else:
+        shm = shared_memory.SharedMemory(create=True, size=max(total, 1) * 8)
+        target = ('shm', shm.name, total)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker,
+                                                    initargs=(factory, )) as executor:
+            futures = [executor.submit(_render_chunk_shared,
+                                       [NoteSpec(n.freq, n.duration, n.denom) for n in chunk_notes], o, target)
+                       for chunk_notes, o in tasks]
+            for future in futures:
+                future.result()
+        if shm is None:
+            return out[:total]
+        result = np.ndarray((total, ), np.float64, shm.buf)
+        if out is None:
+            return result.copy()
+        out[:total] = result
+        return out[:total]
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
@@ -0,0 +1,128 @@
+import numpy as np
+
+from music import constants
+from music import render
+from music import tone
+
+NAMES = ('C', 'Cs', 'D', 'Ds', 'E', 'F', 'Fs', 'G', 'Gs', 'A', 'As', 'B')
+
+DTYPE = np.dtype([
+    ('name', 'U2'),
+    ('note', np.float64),
+    ('octave', np.int16),
+    ('duration', np.float64),
+    ('denom', np.float64),
+])
+
+
+class Score(object):
+    """
+    A sequence of notes stored as the columns of one structured array (``DTYPE``), 34 bytes a note.
+
+    The columns carry the same fields as ``NamedTone``. Slicing gives a ``Score`` sharing the same memory, and
+    ``notes`` iterates ``render.NoteSpec``s, so a score can be passed to ``render.stream_line`` and
+    ``render.render_line_parallel`` in place of a ``MusicLine``.
+    """
+
+    def __init__(self, data):
+        data = np.asarray(data)
+        if data.dtype != DTYPE:
+            raise TypeError('Expected a structured array of {}, got {}'.format(DTYPE, data.dtype))
+        self.data = data
+
+    @classmethod
+    def empty(cls, length):
+        return cls(np.zeros(length, DTYPE))
+
+    @classmethod
+    def from_arrays(cls, names, octaves, durations=1, denoms=1, tuning=None):
+        """
+        :param tuning: a ``constants.WesternTuning`` to look the notes up in (defaults to ``NamedTone.tuning``)
+        """
+        tuning = tone.NamedTone.tuning if tuning is None else tuning
+        names, octaves, durations, denoms = np.broadcast_arrays(names, octaves, durations, denoms)
+        score = cls.empty(names.size)
+        score.data['name'] = names.reshape(-1)
+        score.data['note'] = tuning.freqs(names.reshape(-1), 3)
+        score.data['octave'] = octaves.reshape(-1)
+        score.data['duration'] = durations.reshape(-1)
+        score.data['denom'] = denoms.reshape(-1)
+        return score
+
+    @classmethod
+    def from_line(cls, line):
+        """
+        :param line: a ``MusicLine`` or an iterable of ``NamedTone``s
+        """
+        notes = getattr(line, 'notes', line)
+        return cls(np.array([(n.name, n.note, n.octave, n.duration, n.denom) for n in notes], DTYPE))
+
+    def to_line(self):
+        notes = []
+        for name, note, octave, duration, denom in self.data.tolist():
+            named = tone.NamedTone(name, octave, duration, denom)
+            named.note = note
+            notes.append(named)
+        return tone.MusicLine(notes)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            row = self.data[item]
+            return render.NoteSpec(row['note'] * 2. ** (int(row['octave']) - 3), row['duration'], row['denom'])
+        return Score(self.data[item])
+
+    def __add__(self, other):
+        if not isinstance(other, Score):
+            other = Score.from_line([other] if isinstance(other, tone.NamedTone) else other)
+        return Score(np.concatenate((self.data, other.data)))
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    name = property(lambda self: self.data['name'])
+    note = property(lambda self: self.data['note'])
+    octave = property(lambda self: self.data['octave'])
+    duration = property(lambda self: self.data['duration'])
+    denom = property(lambda self: self.data['denom'])
+
+    @property
+    def freq(self):
+        return self.note * 2. ** (self.octave - 3)
+
+    @property
+    def beats(self):
+        return self.duration * .25 / self.denom
+
+    @property
+    def notes(self):
+        return map(render.NoteSpec, self.freq.tolist(), self.duration.tolist(), self.denom.tolist())
+
+    def midi_keys(self):
+        names, inverse = np.unique(self.name, return_inverse=True)
+        positions = np.array([constants.WesternTuning.positions[n] for n in names], np.int64)
+        return 12 * (self.octave.astype(np.int64) + 1) + positions[inverse]
+
+    def transpose(self, semitones, tuning=None):
+        """
+        A copy moved by ``semitones``, respelled with sharps and retuned in ``tuning`` (defaults to
+        ``NamedTone.tuning``).
+        """
+        tuning = tone.NamedTone.tuning if tuning is None else tuning
+        keys = self.midi_keys() + semitones
+        score = Score(self.data.copy())
+        score.data['name'] = np.array(NAMES)[keys % 12]
+        score.data['octave'] = keys // 12 - 1
+        score.data['note'] = np.asarray(tuning.pitches)[keys % 12]
+        return score
+
+    def scale_tempo(self, factor):
+        """
+        A copy played ``factor`` times as fast.
+        """
+        score = Score(self.data.copy())
+        score.data['duration'] /= factor
+        return score
@@ -1,19 +1,29 @@
 import abc
+import argparse
+import bisect
+import collections
+import concurrent.futures
 import enum
+import os
+import queue
+import threading
 import time
 import typing
 
-import pandas as pd
-import pygame
-import pygame.gfxdraw
-
 from music.tone import NamedTone
+from utils import cache
+from utils import lazy
+
+pygame = lazy.lazy_import('pygame')
+gfxdraw = lazy.lazy_import('pygame.gfxdraw')
+midi_in = lazy.lazy_import('music.midi_in')
+score = lazy.lazy_import('music.score')
 
 WHITE = (255, 255, 255)
 BLACK = (0, 0, 0)
 LIGHT_GRAY = (200, 200, 200)
 
-BASE_C = pd.Series(range(7), index=(6, 8, 10, 11, 1, 3, 5))
+BASE_C = dict(zip((6, 8, 10, 11, 1, 3, 5), range(7)))
 
 
 class PrimaryConfig:
@@ -54,6 +64,10 @@ class EqualityMixin(object):
         return False
 
 
+def _tone_parts(named_tone):
+    return named_tone.name, named_tone.octave
+
+
 class Note(EqualityMixin):
     """
     The information about a note that is notation-independent
@@ -66,7 +80,7 @@ class Note(EqualityMixin):
         self.dynamic = dynamic
 
     def _eq_parts(self):
-        return self.named_tone, self.beat
+        return _tone_parts(self.named_tone), self.beat
 
     @classmethod
     def from_note(cls, note: "Note") -> "Note":
@@ -89,89 +103,402 @@ class RenderableNote(Note):
         self.clef = clef
         self.orientation = orientation
 
+    def _eq_parts(self):
+        return (_tone_parts(self.named_tone), self.beat, self.duration, tuple(self.ornaments), self.clef,
+                self.orientation)
+
     @property
     def clef_rank(self):
         return self.named_tone.rank - self.clef.baseline.rank
 
     @property
     def lined(self):
-        if self.clef_rank % 2 == 0 and (self.clef_rank < 0 or self.clef_rank > 10):
+        if self.clef_rank % 2 == 0 and (self.clef_rank < 0 or self.clef_rank > 8):
             return True
         return False
 
     @classmethod
     def from_note(cls, note):
-        return cls(note=Note.from_note(note), clef=note.clef, orientation=note.orirentation)
+        return cls(note=Note.from_note(note), clef=note.clef, orientation=note.orientation)
 
 
 class MeasuredNote(RenderableNote):
     """
     A note that has been processed relative to its measure, and is ready to be displayed.
     """
-    def __init__(self, note: Note, h_offset, accidental):
-        super().__init__(**note.__dict__)
+    def __init__(self, note: RenderableNote, h_offset, accidental):
+        super().__init__(note=Note.from_note(note), clef=note.clef, orientation=note.orientation)
         self.h_offset = h_offset
         self.accidental = accidental
 
+    def _eq_parts(self):
+        return super()._eq_parts() + (self.h_offset, self.accidental)
+
     @classmethod
     def from_note(cls, note: "MeasuredNote"):
         return cls(note=RenderableNote.from_note(note), h_offset=note.h_offset, accidental=note.accidental)
 
 
+_SHARP_ORDER = 'FCGDAEB'
+_SHARP_KEYS = ('C', 'G', 'D', 'A', 'E', 'B', 'Fs', 'Cs')
+_FLAT_KEYS = ('C', 'F', 'Bf', 'Ef', 'Af', 'Df', 'Gf', 'Cf')
+
+
+def key_signature(key):
+    """
+    The alterations (1 for sharp, -1 for flat) a major key applies, by letter: ``key_signature('D')`` is
+    ``{'F': 1, 'C': 1}``.
+    """
+    if key in _SHARP_KEYS:
+        return {letter: 1 for letter in _SHARP_ORDER[:_SHARP_KEYS.index(key)]}
+    if key in _FLAT_KEYS:
+        return {letter: -1 for letter in _SHARP_ORDER[::-1][:_FLAT_KEYS.index(key)]}
+    raise ValueError('Unknown key {!r}'.format(key))
+
+
+# Where each sign of a key signature sits on the treble staff (two octaves lower on the bass staff).
+_SIGNATURE_OCTAVES = {
+    1: dict(F=5, C=5, G=5, D=5, A=4, E=5, B=4),
+    -1: dict(B=4, E=5, A=4, D=5, G=4, C=5, F=4),
+}
+
+
+def signature_order(key):
+    """
+    The (letter, alteration) pairs of a key signature (as from ``key_signature``) in the order they are written.
+    """
+    sharps = [(letter, 1) for letter in _SHARP_ORDER if key.get(letter) == 1]
+    flats = [(letter, -1) for letter in _SHARP_ORDER[::-1] if key.get(letter) == -1]
+    return sharps + flats
+
+
+def alteration(named_tone):
+    return {'s': 1, 'f': -1}.get(named_tone.name[1:], 0)
+
+
 class MeasureBuilder:
+    """
+    Lays out one measure: notes are grouped into columns by beat, each column gets an ``h_offset`` (leaving room
+    for accidentals and for notes a second apart, which sit side by side), and each note gets the accidental it
+    needs given the key and the accidentals already shown earlier in the measure on its staff.
+    """
     def __init__(self, notes: typing.List[RenderableNote], key, config):
-        self.beats = sorted(set(x.beat for x in notes))
-        raw_notes = {x: [] for x in beats}
-        for note in notes:
-            raw_notes[note.beat].append(note)
+        """
+        :param key: the key signature, as from ``key_signature``
+        :type config: PrimaryConfig
+        """
+        self.notes = list(notes)
+        self.beats = sorted(set(x.beat for x in self.notes))
+        self.raw_notes = {x: [] for x in self.beats}
+        for note in self.notes:
+            self.raw_notes[note.beat].append(note)
         self.effective_key = key
-        self.effective_keys = dict((x.clef, key) for x in notes)
+        self.effective_keys = dict((x.clef, dict(key)) for x in self.notes)
+        self.config = config
+        self.width = 0
+
+    def _accidental(self, note):
+        effective = self.effective_keys[note.clef]
+        letter, octave = note.named_tone.name[0], note.named_tone.octave
+        wanted = alteration(note.named_tone)
+        if effective.get((letter, octave), effective.get(letter, 0)) == wanted:
+            return None
+        effective[(letter, octave)] = wanted
+        return wanted
+
+    @staticmethod
+    def _seconds(chord):
+        """
+        Which notes of a chord (sorted by staff and rank) move beside their neighbour a second below.
+        """
+        shifted = []
+        for i, note in enumerate(chord):
+            below = chord[i - 1] if i else None
+            shifted.append(below is not None and not shifted[-1] and below.clef == note.clef
+                           and note.named_tone.rank - below.named_tone.rank == 1)
+        return shifted
+
+    def layout(self) -> typing.List[MeasuredNote]:
+        width = self.config.note_width
+        x = width
+        measured = []
+        for beat in self.beats:
+            chord = sorted(self.raw_notes[beat], key=lambda n: (n.clef.value, n.named_tone.rank))
+            accidentals = [self._accidental(note) for note in chord]
+            shifted = self._seconds(chord)
+            if any(a is not None for a in accidentals):
+                x += width
+            for note, accidental, shift in zip(chord, accidentals, shifted):
+                measured.append(MeasuredNote(note, x + width if shift else x, accidental))
+            x += width * (2 + max(note.duration for note in chord)) + (width if any(shifted) else 0)
+        self.width = x
+        return measured
+
+
+def split_measures(notes, beats_per_measure=4):
+    """
+    Splits ``RenderableNote``s with beats counted from the start of the piece into measures, with beats counted
+    from the start of each measure.
+    """
+    measures = []
+    for note in sorted(notes, key=lambda n: n.beat):
+        index, beat = measure_beat(note.beat, beats_per_measure)
+        while len(measures) <= index:
+            measures.append([])
+        note = RenderableNote.from_note(note)
+        note.beat = beat
+        measures[index].append(note)
+    return measures
+
+
+def measure_beat(beat, beats_per_measure=4):
+    """
+    :return: (measure index, beat within that measure) for a beat counted from the start of the piece
+    """
+    index, beat = divmod(beat, beats_per_measure)
+    return int(index), beat
+
+
+class ScoreLayout(object):
+    """
+    A piece laid out measure by measure with ``MeasureBuilder``.
+
+    Layouts are cached by measure content (the notes' ``_eq_parts``, the key and the config), so repeated measures
+    are laid out once, and editing one measure lays out only that one; the measures after it just move.
+    """
+
+    def __init__(self, measures=(), key=None, config=None, cache_size=4096):
+        """
+        :param measures: lists of ``RenderableNote``s, beats counted from the start of their measure
+        :param key: a key signature (see ``key_signature``); C major by default
+        """
+        self.key = {} if key is None else dict(key)
+        self.config = PrimaryConfig(13, 9, None) if config is None else config
+        self.cache = cache.LRUCache(cache_size)
+        self.measures = []
+        self.layouts = []  # (measured notes, width) per measure
+        self.starts = []  # x of each measure, then the end of the last
+        self.set_measures(measures)
+
+    def _cache_key(self, notes):
+        notes = sorted(notes, key=lambda n: (n.beat, n.clef.value, n.named_tone.rank, n.named_tone.name))
+        config = self.config.note_width, self.config.note_height
+        return tuple(note._eq_parts() for note in notes), tuple(sorted(self.key.items())), config
+
+    def layout_measure(self, notes):
+        """
+        :return: (tuple of ``MeasuredNote``s, width) for one measure, from the cache when possible
+        """
+        key = self._cache_key(notes)
+        layout = self.cache.get(key, cache.MISSING)
+        if layout is cache.MISSING:
+            builder = MeasureBuilder(notes, self.key, self.config)
+            layout = tuple(builder.layout()), builder.width
+            self.cache.put(key, layout)
+        return layout
+
+    def set_measures(self, measures):
+        self.measures = [list(notes) for notes in measures]
+        self.layouts = [self.layout_measure(notes) for notes in self.measures]
+        self.starts = [0]
+        for _, width in self.layouts:
+            self.starts.append(self.starts[-1] + width)
+
+    def edit(self, index, notes):
+        """
+        Replaces the notes of one measure (``index == len(measures)`` appends one).
+
+        :return: how far the measures after it moved
+        """
+        if index == len(self.measures):
+            self.measures.append([])
+            self.layouts.append(((), 0))
+            self.starts.append(self.starts[-1])
+        self.measures[index] = list(notes)
+        self.layouts[index] = self.layout_measure(self.measures[index])
+        shift = self.starts[index] + self.layouts[index][1] - self.starts[index + 1]
+        if shift:
+            for i in range(index + 1, len(self.starts)):
+                self.starts[i] += shift
+        return shift
+
+    @property
+    def width(self):
+        return self.starts[-1]
+
+    def placed(self, first=0, last=None):
+        """
+        Yields (x, ``MeasuredNote``) for the notes of measures ``first`` to ``last`` (inclusive; default the end).
+        """
+        last = len(self.layouts) - 1 if last is None else last
+        for index in range(first, last + 1):
+            start = self.starts[index]
+            for note in self.layouts[index][0]:
+                yield start + note.h_offset, note
 
 
 class Clefs(enum.Enum):
     Treble = 0
     Bass = 1
 
+    @property
+    def baseline(self):
+        """
+        The note on the bottom line.
+        """
+        return bottom_notes[self]
+
 
 top_notes = {
     Clefs.Treble: NamedTone('F', 5),
     Clefs.Bass: NamedTone('A', 3)
 }
 
+bottom_notes = {
+    Clefs.Treble: NamedTone('E', 4),
+    Clefs.Bass: NamedTone('G', 2)
+}
+
+def piano_key_tone(piano_key):
+    """
+    The ``NamedTone`` of a piano key (1 is A0, as ``midi_in.LiveListener`` numbers them), black keys spelled as
+    sharps.
+    """
+    octave, pitch = divmod(piano_key + midi_in.MIDI_OFFSET, 12)
+    return NamedTone(score.NAMES[pitch], octave - 1)
+
+
+def renderable(named_tone, beat, duration):
+    """
+    A ``RenderableNote`` on a great staff: middle C and above on the treble staff, the rest on the bass staff.
+    """
+    clef = Clefs.Treble if named_tone.octave >= 4 else Clefs.Bass
+    return RenderableNote(Note(named_tone, beat, duration, (), None), clef, Orientations.UpRight)
+
+
+def live_note(x, note):
+    """
+    The ``LiveNote`` drawing a ``MeasuredNote`` at ``x``.
+    """
+    return LiveNote(int(x), 8 - note.clef_rank, note.clef.value, note.duration, note.accidental)
+
+
+def glyph_for(beats):
+    """
+    The ``RenderedNote`` class for a duration in beats (quarter notes).
+    """
+    for limit, cls in ((.75, FlagNote), (1, DottedFlagNote), (1.5, QuarterNote), (2, DottedQuarterNote),
+                       (3, HalfNote), (4, DottedHalfNote)):
+        if beats < limit:
+            return cls
+    return WholeNote
+
 
 class Screen(object):
+    """
+    A retained-mode window: staves record which parts of them changed, and ``update`` repaints only those
+    regions and pushes them to the display with ``pygame.display.update(rects)``.
+
+    A ``headless`` screen draws on an offscreen surface instead and never touches the display, so it works without
+    one (e.g. under ``SDL_VIDEODRIVER=dummy``); ``save`` writes it out as an image.
+    """
     margin = 10
     staff_height = 100
     staffs_per_group = 2
 
-    def __init__(self, width, height):
+    def __init__(self, width, height, headless=False):
         """
         :param width: int
         :param height: int
         """
-        pygame.init()
-        self.screen = pygame.display.set_mode((width, height))
+        self.headless = headless
+        if headless:
+            self.screen = pygame.Surface((width, height))
+        else:
+            pygame.init()
+            self.screen = pygame.display.set_mode((width, height))
         self.staves = []  # type: list[BaseStaff]
         self.clock = pygame.time.Clock()
         self.width = width
         self.height = height
         self._fonts = {}
+        self._moved = []
 
     def run(self):
         self.clock.tick(10)
-        self.draw()
+        self.update()
 
     def draw(self):
         self.screen.fill(WHITE)
         for staff in self.staves:
+            staff.take_dirty()
             staff.draw(self.screen)
-        pygame.display.flip()
+        self._moved = []
+        if not self.headless:
+            pygame.display.flip()
+
+    def update(self):
+        """
+        Repaints what changed since the last ``draw`` or ``update``.
+
+        :return: the rectangles pushed to the display
+        """
+        area = self.screen.get_rect()
+        rects = _merge([r.clip(area) for staff in self.staves for r in staff.take_dirty()])
+        for rect in rects:
+            self.screen.set_clip(rect)
+            self.screen.fill(WHITE, rect)
+            for staff in self.staves:
+                if staff.bounds.colliderect(rect):
+                    staff.draw_region(self.screen, rect)
+        self.screen.set_clip(None)
+        pushed = _merge(rects + self._moved)
+        self._moved = []
+        if pushed and not self.headless:
+            pygame.display.update(pushed)
+        return pushed
+
+    def save(self, filename):
+        """
+        Writes what is drawn so far to an image file (PNG, or whatever the extension asks for).
+        """
+        pygame.image.save(self.screen, filename)
+
+    def scroll(self, staff, dx):
+        """
+        Scrolls ``staff``'s notes ``dx`` pixels to the right (left if negative) by moving the pixels already on
+        screen, so only the strip uncovered (and the caps, which stay put) need drawing.
+        """
+        area = staff.bounds.clip(self.screen.get_rect())
+        self.screen.set_clip(area)
+        self.screen.scroll(dx, 0)
+        self.screen.set_clip(None)
+        self._moved.append(area)
+        staff.scrolled(dx, area)
+
+
+def _merge(rects):
+    """
+    Unions overlapping rectangles, dropping empty ones.
+    """
+    merged = []
+    for rect in rects:
+        if not rect.width or not rect.height:
+            continue
+        rect = rect.copy()
+        i = rect.collidelist(merged)
+        while i != -1:
+            rect.union_ip(merged.pop(i))
+            i = rect.collidelist(merged)
+        merged.append(rect)
+    return merged
 
 
 class BaseStaff(object, metaclass=abc.ABCMeta):
     sub_staves = []
     staves = 1
     white_space = 1
+    note_spacing = 60
 
     def __init__(self, left, top, width, staff_height):
         self.left = left
@@ -183,6 +510,74 @@ class BaseStaff(object, metaclass=abc.ABCMeta):
         self.note_width = int(1.5 * self.space)
         self.width = width
         self.notes = [1, 2, 3, 13, 6, 8, 10, 9, 4, 3, 2]  # Placeholder, should be typed
+        self.key = {}  # the key signature drawn after the left cap, as from ``key_signature``
+        self.scroll_x = 0
+        # Room around the staff for ledger lines, stems and notes hanging over the caps.
+        pad_x, pad_y = self.note_spacing // 2, 2 * staff_height
+        self.bounds = pygame.Rect(left - pad_x, top - pad_y, width + 2 * pad_x + 1,
+                                  self.bottom - top + 2 * pad_y + 1)
+        self._dirty = [self.bounds]
+
+    def invalidate(self, rect=None):
+        """
+        Marks ``rect`` (default: the whole staff) for repainting on the next ``Screen.update``.
+        """
+        self._dirty.append(self.bounds if rect is None else rect)
+
+    def take_dirty(self):
+        dirty, self._dirty = self._dirty, []
+        return dirty
+
+    def note_x(self, index):
+        return index * self.note_spacing - self.scroll_x
+
+    def note_rect(self, index):
+        return pygame.Rect(self.note_x(index) - self.note_spacing // 2, self.bounds.top,
+                           self.note_spacing, self.bounds.height)
+
+    def notes_in(self, rect):
+        """
+        The indices of the notes that may draw inside ``rect``.
+        """
+        first = max((rect.left + self.scroll_x) // self.note_spacing, 0)
+        last = min((rect.right + self.scroll_x) // self.note_spacing + 1, len(self.notes) - 1)
+        return range(first, last + 1)
+
+    def set_notes(self, notes):
+        self.notes = list(notes)
+        self.invalidate()
+
+    def append_note(self, note):
+        self.notes.append(note)
+        self.invalidate(self.note_rect(len(self.notes) - 1))
+
+    def replace_note(self, index, note):
+        self.notes[index] = note
+        self.invalidate(self.note_rect(index))
+
+    def scrolled(self, dx, area):
+        """
+        Called by ``Screen.scroll`` once the pixels in ``area`` have moved ``dx`` to the right.
+        """
+        self.scroll_x -= dx
+        # Whatever was waiting to be repainted moved with the pixels.
+        self._dirty = [rect.move(dx, 0) for rect in self._dirty]
+        if dx < 0:
+            self.invalidate(pygame.Rect(area.right + dx, area.top, -dx, area.height))
+        elif dx > 0:
+            self.invalidate(pygame.Rect(area.left, area.top, dx, area.height))
+        for side in (self.left, self.right):
+            self.invalidate(pygame.Rect(min(side, side + dx) - 1, self.top, abs(dx) + 3, self.bottom - self.top + 1))
+        if self.key:  # the signature stays put too
+            self.invalidate(pygame.Rect(self.left, self.bounds.top, self.signature_width + abs(dx),
+                                        self.bounds.height))
+
+    @property
+    def signature_width(self):
+        """
+        The room the key signature takes after the left cap (none in C).
+        """
+        return self.note_width * (len(signature_order(self.key)) + 1) if self.key else 0
 
     def draw_veritical_line(self, screen, position):
         pygame.draw.line(screen, BLACK, (position, self.top), (position, self.bottom))
@@ -198,14 +593,34 @@ class BaseStaff(object, metaclass=abc.ABCMeta):
                 pygame.draw.line(screen, BLACK, (stave.left, top), (stave.right, top))
 
     def draw(self, screen):
+        self.draw_region(screen, self.bounds)
+
+    def draw_region(self, screen, rect):
+        """
+        Draws the parts of the staff that fall inside ``rect``; the caller clips to it.
+        """
         self.draw_staves(screen)
         self.draw_caps(screen)
-        for i, note in enumerate(self.notes):
-            print(note)
-            self.draw_note(screen, note, i * 60, 1,)
+        batch = []
+        for stave in self.sub_staves:
+            batch.extend(stave.signature_glyphs(self.key))
+        for i in self.notes_in(rect):
+            self.draw_note(screen, *self._note_args(i, self.notes[i]), batch=batch)
+        screen.blits(batch, doreturn=False)
+
+    def _note_args(self, index, note):
+        """
+        The arguments after ``screen`` for ``draw_note``.
+        """
+        return note, self.note_x(index), 3  # the placeholder notes are dotted halves
 
     @abc.abstractmethod
-    def draw_note(self, screen, note, offset, beats, accidental=0, up=True, sub_staff=0):
+    def draw_note(self, screen, note, offset, beats, accidental=None, up=True, sub_staff=0, batch=None):
+        """
+        :param accidental: 1 for a sharp, -1 for a flat, 0 for a natural, None for no sign
+        :param batch: a list to append the note's (glyph, position) to for one ``screen.blits`` call, instead of
+            blitting it right away
+        """
         pass
 
 
@@ -220,15 +635,40 @@ class Staff(BaseStaff):
     def sub_staves(self):
         return [self]
 
+    def signature_positions(self, key):
+        """
+        (sign, half-spaces below the top line) of each accidental of ``key`` on this staff, in writing order.
+        """
+        shift = 0 if self.clef == Clefs.Treble else 2
+        top = top_notes[self.clef].rank
+        return [(sign, top - NamedTone(letter, _SIGNATURE_OCTAVES[sign][letter] - shift).rank)
+                for letter, sign in signature_order(key)]
+
+    def signature_glyphs(self, key):
+        """
+        The ``GLYPHS.place`` tuples drawing ``key``'s signature just after the left cap.
+        """
+        return [GLYPHS.place(ACCIDENTALS[sign](self.left + self.note_width * (i + 1),
+                                               self.top + int(self.space * position / 2), self.note_width,
+                                               self.space))
+                for i, (sign, position) in enumerate(self.signature_positions(key))]
+
     def draw(self, screen):
         super(Staff, self).draw(screen)
 
-    def draw_note(self, screen, note, offset, beats, accidental=0, up=True, sub_staff=0):
+    def draw_note(self, screen, note, offset, beats, accidental=None, up=True, sub_staff=0, batch=None):
         space = self.space
         vert_mid = self.top + int(space * note/2)
-        rendered_note = DottedHalfNote(offset, vert_mid, self.note_width, self.space)
-        rendered_note.draw(screen)
-        rendered_note.finalize(screen)
+        orientation = Orientations.UpRight if up else Orientations.DownLeft
+        rendered_note = glyph_for(beats)(offset, vert_mid, self.note_width, self.space, orientation)
+        glyphs = [GLYPHS.place(rendered_note)]
+        if accidental is not None:
+            sign = ACCIDENTALS[accidental](offset - int(1.1 * self.note_width), vert_mid, self.note_width, self.space)
+            glyphs.append(GLYPHS.place(sign))
+        if batch is None:
+            screen.blits(glyphs, doreturn=False)
+        else:
+            batch.extend(glyphs)
         overhang = rendered_note.overhang * rendered_note.width
         o_left = rendered_note.left - overhang
         o_right = rendered_note.right + overhang
@@ -286,7 +726,7 @@ class RenderedNote:
             self.stem_tip = self.stem_base[0], y + self.stem_multiplier * self.height
 
     def draw_elipse(self, screen):
-        pygame.gfxdraw.aaellipse(screen, *self.gfx_elipse_args, self.color)
+        gfxdraw.aaellipse(screen, *self.gfx_elipse_args, self.color)
 
     def draw_stem(self, screen):
         pygame.draw.line(screen, self.color, self.stem_base, self.stem_tip)
@@ -307,7 +747,7 @@ class RenderedNote:
 
 
 class WholeNote(RenderedNote):
-    def draw_stem(self):
+    def draw_stem(self, screen):
         pass
 
 
@@ -318,7 +758,7 @@ class HalfNote(RenderedNote):
 class QuarterNote(RenderedNote):
     def draw_elipse(self, screen):
         super().draw_elipse(screen)
-        pygame.gfxdraw.filled_ellipse(screen, *self.gfx_elipse_args, self.color)
+        gfxdraw.filled_ellipse(screen, *self.gfx_elipse_args, self.color)
         
 
 class _DottedNote(RenderedNote):
@@ -327,7 +767,7 @@ class _DottedNote(RenderedNote):
         distance = int(self.dot_distance * self.width)
         offset = int(self.dot_offset * self.height)
         # LoL
-        pygame.gfxdraw.filled_circle(screen, self.right + distance, self.y + offset, 1, self.color)
+        gfxdraw.filled_circle(screen, self.right + distance, self.y + offset, 1, self.color)
 
 
 class DottedWholeNote(WholeNote, _DottedNote):
@@ -349,6 +789,110 @@ class DottedFlagNote(FlagNote, _DottedNote):
     pass
 
 
+class Accidental(RenderedNote):
+    """
+    A sharp, flat or natural sign centred on (x, y), sized for a note head ``width`` by ``height``.
+    """
+
+    def draw(self, screen):
+        self.draw_sign(screen, self.x, self.gfx_elipse_args[1], self.width // 4, self.height)
+
+    def draw_sign(self, screen, x, y, q, h):
+        raise NotImplementedError(type(self))
+
+    def draw_stem(self, screen):
+        pass
+
+
+class Sharp(Accidental):
+    def draw_sign(self, screen, x, y, q, h):
+        for dx in (-q, q):
+            pygame.draw.line(screen, self.color, (x + dx, y - 3 * h // 2), (x + dx, y + 3 * h // 2))
+        for dy in (-h // 2, h // 2):
+            pygame.draw.line(screen, self.color, (x - 2 * q, y + dy + 1), (x + 2 * q, y + dy - 1), 2)
+
+
+class Flat(Accidental):
+    def draw_sign(self, screen, x, y, q, h):
+        pygame.draw.line(screen, self.color, (x - q, y - 2 * h), (x - q, y + h // 2))
+        pygame.draw.lines(screen, self.color, False,
+                          [(x - q, y - h // 4), (x + q - 1, y - h // 2), (x + q, y), (x - q, y + h // 2)])
+
+
+class Natural(Accidental):
+    def draw_sign(self, screen, x, y, q, h):
+        pygame.draw.line(screen, self.color, (x - q, y - 3 * h // 2), (x - q, y + h // 2))
+        pygame.draw.line(screen, self.color, (x + q, y - h // 2), (x + q, y + 3 * h // 2))
+        for dy in (-h // 2, h // 2):
+            pygame.draw.line(screen, self.color, (x - q, y + dy + 1), (x + q, y + dy - 1), 2)
+
+
+ACCIDENTALS = {1: Sharp, -1: Flat, 0: Natural}
+
+
+class GlyphCache(object):
+    """
+    Notes pre-rasterized onto offscreen surfaces, one per (note class, size, orientation, color, ornaments), so
+    drawing a note is a single blit.
+
+    Glyphs are drawn on white and blitted with ``BLEND_RGB_MIN``, which keeps the darker of glyph and page: on
+    paper that is exactly what drawing the note directly gives (anti-aliased edges included), and staff lines
+    under a note show through its hollow parts.
+    """
+
+    def __init__(self):
+        self._glyphs = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._glyphs)
+
+    def clear(self):
+        self._glyphs.clear()
+
+    def get(self, note):
+        """
+        :type note: RenderedNote
+        :return: (surface, (dx, dy)): the glyph and where its top left corner sits relative to the note's centre
+        """
+        key = type(note), note.width, note.height, note.orientation, note.color, note.ornaments
+        try:
+            glyph = self._glyphs[key]
+        except KeyError:
+            self.misses += 1
+            glyph = self._glyphs[key] = self._rasterize(note)
+        else:
+            self.hits += 1
+        return glyph
+
+    def place(self, note):
+        """
+        :return: (surface, position, area, special_flags) ready for ``blit``/``blits``
+        """
+        surface, (dx, dy) = self.get(note)
+        x, y = note.gfx_elipse_args[:2]
+        return surface, (x + dx, y + dy), None, pygame.BLEND_RGB_MIN
+
+    @staticmethod
+    def _rasterize(note):
+        # Room for the stem either way, the dot to the right and anti-aliasing at the edges.
+        cx = 2 * note.width + 2
+        cy = note.stem_multiplier * note.height + note.height + 2
+        surface = pygame.Surface((2 * cx + 1, 2 * cy + 1))
+        surface.fill(WHITE)
+        glyph = type(note)(cx, cy, note.width, note.height, note.orientation, note.color, note.ornaments)
+        glyph.ornaments = note.ornaments
+        glyph.draw(surface)
+        glyph.finalize(surface)
+        if pygame.display.get_surface() is not None:
+            surface = surface.convert()
+        return surface, (-cx, -cy)
+
+
+GLYPHS = GlyphCache()  # per process
+
+
 class GreatStaff(BaseStaff):
     staves = 2
 
@@ -361,22 +905,367 @@ class GreatStaff(BaseStaff):
     def draw(self, screen):
         super(GreatStaff, self).draw(screen)
 
-    def draw_note(self, screen, note, offset, beats, accidental=0, up=True, sub_staff=0):
-        self.sub_staves[sub_staff].draw_note(screen, note, offset, beats, accidental)
+    def draw_note(self, screen, note, offset, beats, accidental=None, up=True, sub_staff=0, batch=None):
+        self.sub_staves[sub_staff].draw_note(screen, note, offset, beats, accidental, up, batch=batch)
+
+
+LiveNote = collections.namedtuple('LiveNote', ['x', 'position', 'sub_staff', 'beats', 'accidental'])
+
+
+class LiveStaff(GreatStaff):
+    """
+    A ``GreatStaff`` of ``LiveNote``s and bar lines placed by a ``LiveLayout``, at x positions measured from the
+    start of the piece (so scrolling never moves them).
+    """
+
+    def __init__(self, left, top, width, staff_height):
+        super().__init__(left, top, width, staff_height)
+        self.notes = []
+        self.bars = []
+        self._xs = []
+
+    def note_x(self, index):
+        return self.left + self.notes[index].x - self.scroll_x
+
+    def notes_in(self, rect):
+        low = rect.left - self.left + self.scroll_x - self.note_spacing
+        high = rect.right - self.left + self.scroll_x + self.note_spacing
+        return range(bisect.bisect_left(self._xs, low), bisect.bisect_right(self._xs, high))
+
+    def set_notes(self, notes):
+        self._xs = [note.x for note in notes]
+        super().set_notes(notes)
+
+    def append_note(self, note):
+        if self._xs and note.x < self._xs[-1]:
+            raise ValueError('Live notes must be appended in order of x')
+        self._xs.append(note.x)
+        super().append_note(note)
+
+    def replace_note(self, index, note):
+        if note.x != self._xs[index]:
+            raise ValueError('Replacing a live note must keep its x')
+        super().replace_note(index, note)
+
+    def set_tail(self, first, notes):
+        """
+        Replaces the notes from index ``first`` on (the chord being played) with ``notes``, which may move.
+        """
+        for index in range(first, len(self.notes)):
+            self.invalidate(self.note_rect(index))
+        del self.notes[first:]
+        del self._xs[first:]
+        for note in notes:
+            self.append_note(note)
+
+    def add_bar(self, x):
+        self.bars.append(x)
+        screen_x = self.left + x - self.scroll_x
+        self.invalidate(pygame.Rect(screen_x - 1, self.top, 3, self.bottom - self.top + 1))
+
+    def draw_region(self, screen, rect):
+        super().draw_region(screen, rect)
+        low, high = rect.left - self.left + self.scroll_x - 1, rect.right - self.left + self.scroll_x + 1
+        for x in self.bars[bisect.bisect_left(self.bars, low):bisect.bisect_right(self.bars, high)]:
+            self.draw_veritical_line(screen, self.left + x - self.scroll_x)
+
+    def _note_args(self, index, note):
+        return note.position, self.note_x(index), note.beats, note.accidental, note.position > 4, note.sub_staff
+
+
+class LiveLayout(object):
+    """
+    Lays out notes played on a ``midi_in.LiveListener`` for a ``LiveStaff`` on a worker thread, so a burst of
+    notes never holds up the listener or the display.
+
+    Add it to the listener's sinks: ``note_on`` only timestamps the key and queues it. The worker groups notes into
+    chords and quantizes them with a ``midi_in.RhythmTracker``. Each chord is placed at the beat where the previous
+    one ended, drawn as a quarter note until the next chord reveals its length. Measures are laid out by a
+    ``ScoreLayout`` exactly as ``engrave`` lays them out; only the last measure ever changes, and in it only the
+    chord being played. The results are queued as ``changes`` for the render thread to apply: ('tail', index,
+    notes), the chord's ``LiveNote``s from staff index ``index`` on, and ('bar', x).
+    """
+
+    def __init__(self, beats_per_measure=4, tracker=None, key=None, config=None, left=0):
+        """
+        :param key: the key signature (as from ``key_signature``), for the accidentals
+        :param left: x of the first measure, e.g. the staff's ``signature_width``
+        """
+        self.beats_per_measure = beats_per_measure
+        self.tracker = midi_in.RhythmTracker() if tracker is None else tracker
+        self.layout = ScoreLayout(key=key, config=config)
+        self.left = left
+        self.changes = collections.deque()
+        self.inbox = queue.Queue()
+        self.beat = 0.
+        self.count = 0
+        self._chord = []  # the RenderableNotes of the current chord
+        self._first = 0  # the staff index of its first note
+        self._thread = None
+
+    # Sink interface for midi_in.LiveListener; called from the listener's thread.
 
+    def note_on(self, key, velocity):
+        self.inbox.put((time.time(), key))
 
-screen = Screen(800, 600)
-screen.staves.append(GreatStaff(20, 20, 760, 36))
-screen.draw()
-running = True
-while running:
-    events = pygame.event.get()
-    for event in events:
-        if event.type == pygame.KEYDOWN:
-            print(event.key)
-            if event.key == pygame.K_x:
+    def note_off(self, key):
+        pass
+
+    def sustain_pedal(self, depressed):
+        pass
+
+    def sostenuto_pedal(self, depressed):
+        pass
+
+    def soft_pedal(self, depressed):
+        pass
+
+    # Worker thread.
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='LiveLayout', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self.inbox.put(None)
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self):
+        while True:
+            item = self.inbox.get()
+            if item is None:
+                break
+            self.add_note(*item)
+
+    def add_note(self, start, key):
+        tracker = self.tracker
+        joins = bool(self._chord) and start - tracker.chord_start < tracker.threshold
+        quantized = tracker.add_note(start)
+        if not joins:
+            if self._chord:
+                beats = 1. if quantized is None or quantized.num is None else quantized.num / quantized.denom
+                self._finish_chord(max(beats, .25))
+            self._chord = []
+            self._first = self.count
+        self._chord.append(renderable(piano_key_tone(key), measure_beat(self.beat, self.beats_per_measure)[1], 1.))
+        self._place_chord()
+
+    def _open_measures(self, index):
+        layout = self.layout
+        while len(layout.measures) <= index:
+            layout.edit(len(layout.measures), [])
+            if len(layout.measures) > 1:
+                self.changes.append(('bar', int(self.left + layout.starts[len(layout.measures) - 1])))
+
+    def _place_chord(self):
+        index, beat = measure_beat(self.beat, self.beats_per_measure)
+        self._open_measures(index)
+        layout = self.layout
+        earlier = [note for note in layout.measures[index] if note.beat != beat]
+        layout.edit(index, earlier + self._chord)
+        start = self.left + layout.starts[index]
+        chord = sorted((note for note in layout.layouts[index][0] if note.beat == beat),
+                       key=lambda note: (note.h_offset, note.clef.value, note.named_tone.rank))
+        self.changes.append(('tail', self._first, [live_note(start + note.h_offset, note) for note in chord]))
+        self.count = self._first + len(chord)
+
+    def _finish_chord(self, beats):
+        for note in self._chord:
+            note.duration = beats
+        self._place_chord()
+        self.beat += beats
+        self._open_measures(measure_beat(self.beat, self.beats_per_measure)[0])
+
+
+class LiveScoreView(object):
+    """
+    Renders a ``LiveStaff`` at a steady frame rate, applying whatever the layout produced since the last frame and
+    scrolling to keep the newest note in view.
+    """
+    fps = 60
+
+    def __init__(self, screen, staff, layout, follow_margin=120):
+        self.screen = screen
+        self.staff = staff
+        self.layout = layout
+        self.follow_margin = follow_margin
+        self.frames = 0
+
+    def step(self):
+        """
+        Draws one frame.
+
+        :return: the rectangles pushed to the display
+        """
+        staff, changes = self.staff, self.layout.changes
+        while changes:
+            change = changes.popleft()
+            if change[0] == 'tail':
+                staff.set_tail(*change[1:])
+            else:
+                staff.add_bar(change[1])
+        if staff.notes:
+            overshoot = staff.note_x(len(staff.notes) - 1) - (staff.right - self.follow_margin)
+            if overshoot > 0:
+                self.screen.scroll(staff, -overshoot)
+        self.frames += 1
+        return self.screen.update()
+
+    def run(self):
+        """
+        Runs the display loop on this thread until the window is closed or 'x' is pressed.
+        """
+        clock = pygame.time.Clock()
+        running = True
+        while running:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_x):
+                    running = False
+            self.step()
+            clock.tick(self.fps)
+
+
+def live(connection_id=20, width=800, height=300):
+    """
+    Shows what is played on a MIDI keyboard as a scrolling score.
+    """
+    screen = Screen(width, height)
+    staff = LiveStaff(20, 60, width - 40, 36)
+    screen.staves.append(staff)
+    layout = LiveLayout()
+    listener = midi_in.LiveListener(connection_id, sinks=[layout])
+    layout.start()
+    listener.start()
+    screen.draw()
+    try:
+        LiveScoreView(screen, staff, layout).run()
+    finally:
+        layout.stop()
+
+
+def score_notes(line):
+    """
+    ``RenderableNote``s for a ``MusicLine``, ``score.Score`` or iterable of ``NamedTone``s played one after another,
+    with beats counted in quarter notes (``duration / denom``) from the start. Middle C and above go on the treble
+    staff.
+    """
+    if hasattr(line, 'to_line'):
+        line = line.to_line()
+    notes, beat = [], 0.
+    for named in getattr(line, 'notes', line):
+        duration = named.duration / named.denom
+        notes.append(renderable(named, beat, duration))
+        beat += duration
+    return notes
+
+
+def _systems(layout, width):
+    """
+    Splits a ``ScoreLayout``'s measures into lines no wider than ``width`` (a measure wider than that gets a line
+    of its own).
+
+    :return: (first, last) measure indices of each line
+    """
+    systems, first = [], 0
+    for index in range(1, len(layout.measures) + 1):
+        if index == len(layout.measures) or layout.starts[index + 1] - layout.starts[first] > width:
+            systems.append((first, index - 1))
+            first = index
+    return systems
+
+
+def engrave(line, width=800, staff_height=36, key='C', beats_per_measure=4, max_systems=None):
+    """
+    Lays out a whole score as rows of great staves (``LiveStaff``s, one line of measures each) on a headless
+    ``Screen`` tall enough to hold them.
+
+    :param line: anything ``score_notes`` takes
+    :param key: the major key, e.g. 'D' or 'Bf'; its signature starts every line
+    :param max_systems: draw only this many lines (e.g. for thumbnails)
+    :return: the drawn ``Screen``
+    """
+    margin = staff_height
+    staff_width = width - 2 * margin
+    staff = LiveStaff(margin, 0, staff_width, staff_height)
+    staff.key = key_signature(key)
+    layout = ScoreLayout(split_measures(score_notes(line), beats_per_measure), staff.key,
+                         PrimaryConfig(staff.note_width, staff.space, None))
+    systems = _systems(layout, staff_width - staff.note_width - staff.signature_width)[:max_systems]
+    system_height = 4 * staff_height
+    screen = Screen(width, 2 * margin + max(len(systems), 1) * system_height - staff_height, headless=True)
+    for row, (first, last) in enumerate(systems):
+        staff = LiveStaff(margin, margin + row * system_height, staff_width, staff_height)
+        staff.key = layout.key
+        start = layout.starts[first] - staff.signature_width
+        staff.set_notes([live_note(x - start, note) for x, note in layout.placed(first, last)])
+        staff.bars = [int(x - start) for x in layout.starts[first + 1:last + 1]]
+        screen.staves.append(staff)
+    screen.draw()
+    return screen
+
+
+def _render_job(job):
+    line, filename, kwargs = job
+    engrave(line, **kwargs).save(filename)
+    return filename
+
+
+def _init_worker():
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+
+def render_batch(jobs, workers=None, chunksize=8, **kwargs):
+    """
+    Engraves many scores to image files on a process pool. Each worker process keeps its own ``GLYPHS``, so every
+    glyph is rasterized once per process rather than once per score.
+
+    :param jobs: (score, filename) pairs, scores being anything ``score_notes`` takes (and picklable)
+    :param kwargs: passed on to ``engrave``
+    :return: the filenames written, in order
+    """
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker) as executor:
+        return list(executor.map(_render_job, ((line, filename, kwargs) for line, filename in jobs),
+                                 chunksize=chunksize))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Shows a great staff, or with --live, what a MIDI keyboard plays.'
+                                                 ' With --png, engraves the example melody to an image file.')
+    parser.add_argument('--live', action='store_true')
+    parser.add_argument('--connection-id', type=int, default=20, help='ALSA sequencer client to listen to')
+    parser.add_argument('--png', help='engrave the example melody to this image file instead, without a display')
+    parser.add_argument('--beats-per-measure', type=int, default=4)
+    args = parser.parse_args(argv)
+    if args.live:
+        live(args.connection_id)
+        return
+    if args.png:
+        from music import tone
+        engrave(tone.melody, beats_per_measure=args.beats_per_measure).save(args.png)
+        return
+    screen = Screen(800, 600)
+    screen.staves.append(GreatStaff(20, 20, 760, 36))
+    screen.draw()
+    running = True
+    while running:
+        events = pygame.event.get()
+        for event in events:
+            if event.type == pygame.QUIT:
                 running = False
-            elif event.key == pygame.K_r:
-                screen = Screen(800, 600)
-                screen.staves.append(GreatStaff(20, 200, 760, 36))
-                screen.draw()
+            elif event.type == pygame.KEYDOWN:
+                print(event.key)
+                if event.key == pygame.K_x:
+                    running = False
+                elif event.key == pygame.K_r:
+                    screen = Screen(800, 600)
+                    screen.staves.append(GreatStaff(20, 200, 760, 36))
+                    screen.draw()
+                elif event.key in (pygame.K_LEFT, pygame.K_RIGHT):
+                    screen.scroll(screen.staves[0], 30 if event.key == pygame.K_LEFT else -30)
+        screen.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+import collections
+import time
+
+import numpy as np
+
+A4_KEY = 49  # piano key numbering, as produced by midi_in.LiveListener
+NOTE_ON = 0
+NOTE_OFF = 1
+SUSTAIN = 2
+SOSTENUTO = 3
+SOFT = 4
+
+ATTACK = 0
+DECAY = 1
+RELEASE = 2
+
+
+def equal_tempered_freqs(keys=128):
+    """
+    Frequencies for piano keys in the convention of ``NamedTone.freq`` (which ``ToneFactory.render`` halves).
+    """
+    return 2 * 440. * 2 ** ((np.arange(keys) - A4_KEY) / 12)
+
+
+def _sample_type(width):
+    return np.dtype(np.uint8) if width == 1 else np.dtype('<i{}'.format(width))
+
+
+class Voice(object):
+    """
+    One sounding key. All of its buffers are allocated up front and reused for every note it plays.
+    """
+    __slots__ = ('key', 'stage', 'gain', 'peak', 'sustained', 'sostenuto', 'started',
+                 'omegas', 'phases', 'samples', 'steps')
+
+    def __init__(self, partials, block_size):
+        self.key = None
+        self.stage = RELEASE
+        self.gain = 0.
+        self.peak = 0.
+        self.sustained = False
+        self.sostenuto = False
+        self.started = 0
+        self.omegas = np.zeros(partials)
+        self.phases = np.zeros(partials)
+        self.samples = np.zeros(block_size)
+        self.steps = np.zeros(partials)
+
+    @property
+    def free(self):
+        return self.key is None
+
+
+class Synth(object):
+    """
+    A polyphonic real-time voice engine driven by ``LiveListener`` events.
+
+    Add it to a listener's sinks; events are queued from the listener's thread and applied at the start of the
+    next audio block. Each voice is an additive oscillator bank over the factory's harmonics, rendered
+    ``block_size`` frames at a time into preallocated buffers, so the audio callback allocates no arrays.
+    """
+
+    def __init__(self, factory, block_size=256, latency=.02, max_voices=16,
+                 attack=.005, decay=2., sustain=.3, release=.2, soft_gain=.6, gain=.5, freqs=None, filters=()):
+        """
+        :param factory: an ``HToneFactory`` supplying width, framerate and harmonics
+        :param latency: seconds; the block size must fit in this budget
+        :param decay: seconds to decay from the peak to ``sustain`` times the peak while a key is held
+        :param freqs: frequencies indexed by piano key (defaults to equal temperament)
+        :param filters: ``filters.Filter`` stages run over each block of the mix, before the gain; they should
+            not allocate (those in ``music.filters`` don't)
+        """
+        if block_size / factory.framerate > latency:
+            raise ValueError('A block of {} frames at {}Hz exceeds the {}s latency budget'.format(
+                block_size, factory.framerate, latency))
+        self.factory = factory
+        self.block_size = block_size
+        self.latency = latency
+        self.soft_gain = soft_gain
+        self.gain = gain
+        self.sustain_level = sustain
+        self.freqs = equal_tempered_freqs() if freqs is None else np.asarray(freqs, np.float64)
+        self.filters = tuple(filters)
+        frames = lambda seconds: max(seconds * factory.framerate, 1.)
+        self.attack_step = 1. / frames(attack)
+        self.decay_step = (1. - sustain) / frames(decay)
+        self.release_step = 1. / frames(release)
+
+        self.mults = np.array(list(factory.harmonics.keys()), np.float64)
+        self.weights = np.array(list(factory.harmonics.values()), np.float64)
+        self.voices = [Voice(len(self.mults), block_size) for _ in range(max_voices)]
+        self.events = collections.deque()
+        self.sustain = False
+        self.sostenuto = False
+        self.soft = False
+        self.overruns = 0
+        self.blocks = 0
+        self._clock = 0
+        self._ramp = np.arange(1, block_size + 1, dtype=np.float64)
+        self._times = np.arange(block_size, dtype=np.float64)
+        self._scratch = np.empty((len(self.mults), block_size))
+        self._envelope = np.empty(block_size)
+        self._mix = np.empty(block_size)
+        self._out = np.empty(block_size, _sample_type(factory.width))
+        self._callback_out = np.empty(block_size, _sample_type(factory.width))
+        self._stream = None
+        self._audio = None
+        self._continue = None
+
+    # Sink interface for midi_in.LiveListener; called from the listener's thread.
+
+    def note_on(self, key, velocity):
+        self.events.append((NOTE_ON, key, velocity))
+
+    def note_off(self, key):
+        self.events.append((NOTE_OFF, key, 0))
+
+    def sustain_pedal(self, depressed):
+        self.events.append((SUSTAIN, None, depressed))
+
+    def sostenuto_pedal(self, depressed):
+        self.events.append((SOSTENUTO, None, depressed))
+
+    def soft_pedal(self, depressed):
+        self.events.append((SOFT, None, depressed))
+
+    # Audio thread.
+
+    def _apply_events(self):
+        while self.events:
+            typ, key, value = self.events.popleft()
+            if typ == NOTE_ON:
+                self._start_voice(key, value)
+            elif typ == NOTE_OFF:
+                for voice in self.voices:
+                    if voice.key == key and voice.stage != RELEASE:
+                        if self.sustain or (self.sostenuto and voice.sostenuto):
+                            voice.sustained = True
+                        else:
+                            voice.stage = RELEASE
+            elif typ == SUSTAIN:
+                self.sustain = bool(value)
+                if not self.sustain:
+                    self._release_sustained()
+            elif typ == SOSTENUTO:
+                self.sostenuto = bool(value)
+                for voice in self.voices:
+                    voice.sostenuto = self.sostenuto and not voice.free and voice.stage != RELEASE
+                if not self.sostenuto:
+                    self._release_sustained()
+            elif typ == SOFT:
+                self.soft = bool(value)
+
+    def _release_sustained(self):
+        for voice in self.voices:
+            if voice.sustained and not self.sustain and not (self.sostenuto and voice.sostenuto):
+                voice.sustained = False
+                voice.stage = RELEASE
+
+    def _steal_voice(self, key):
+        """
+        Picks the voice for a new note: the one already playing ``key``, else a free one, else the quietest
+        released one, else the oldest.
+        """
+        for voice in self.voices:
+            if voice.key == key:
+                return voice
+        best = None
+        for voice in self.voices:
+            if voice.free:
+                return voice
+            if best is None or (voice.stage == RELEASE, -voice.gain, -voice.started) > (
+                    best.stage == RELEASE, -best.gain, -best.started):
+                best = voice
+        return best
+
+    def _start_voice(self, key, velocity):
+        voice = self._steal_voice(key)
+        if voice.key != key:
+            voice.gain = 0.
+            voice.phases[:] = 0
+        voice.key = key
+        voice.stage = ATTACK
+        voice.peak = velocity / 127. * (self.soft_gain if self.soft else 1.)
+        voice.sustained = False
+        voice.sostenuto = False
+        voice.started = self._clock
+        self._clock += 1
+        np.multiply(self.mults, self.freqs[key] * np.pi / self.factory.framerate, out=voice.omegas)
+
+    def _render_voice(self, voice, frames):
+        scratch = self._scratch[:, :frames]
+        np.outer(voice.omegas, self._times[:frames], out=scratch)
+        scratch += voice.phases[:, None]
+        np.sin(scratch, out=scratch)
+        samples = voice.samples[:frames]
+        np.dot(self.weights, scratch, out=samples)
+        np.multiply(voice.omegas, frames, out=voice.steps)
+        voice.phases += voice.steps
+        np.mod(voice.phases, 2 * np.pi, out=voice.phases)
+
+        envelope = self._envelope[:frames]
+        if voice.stage == ATTACK:
+            step, low, high = self.attack_step * voice.peak, 0., voice.peak
+        elif voice.stage == DECAY:
+            step, low, high = -self.decay_step * voice.peak, self.sustain_level * voice.peak, voice.peak
+        else:
+            step, low, high = -self.release_step * max(voice.peak, 1e-9), 0., voice.peak
+        np.multiply(self._ramp[:frames], step, out=envelope)
+        envelope += voice.gain
+        np.clip(envelope, low, high, out=envelope)
+        voice.gain = float(envelope[-1])
+        if voice.stage == ATTACK and voice.gain >= voice.peak:
+            voice.stage = DECAY
+        elif voice.stage == RELEASE and voice.gain <= 0:
+            voice.key = None
+
+        samples *= envelope
+        self._mix[:frames] += samples
+
+    def render_block(self, frames=None):
+        """
+        Mixes the next ``frames`` (at most ``block_size``) frames of every sounding voice.
+
+        :return: the preallocated output buffer of samples at the factory's width (reused by the next call)
+        """
+        frames = self.block_size if frames is None else frames
+        start = time.perf_counter()
+        self._apply_events()
+        mix = self._mix[:frames]
+        mix[:] = 0
+        for voice in self.voices:
+            if not voice.free:
+                self._render_voice(voice, frames)
+        for stage in self.filters:
+            stage.process(mix)
+        mix *= self.gain
+        np.tanh(mix, out=mix)
+        mix *= self.factory._width
+        if self.factory.width == 1:
+            mix += self.factory._width
+        out = self._out[:frames]
+        np.copyto(out, mix, casting='unsafe')
+        self.blocks += 1
+        if time.perf_counter() - start > frames / self.factory.framerate:
+            self.overruns += 1
+        return out
+
+    def fill(self, frame_count):
+        """
+        Renders ``frame_count`` frames as consecutive blocks of at most ``block_size``.
+
+        :return: a preallocated buffer of samples (reused by the next call; it only grows for larger requests)
+        """
+        if frame_count > len(self._callback_out):
+            self._callback_out = np.empty(frame_count, self._callback_out.dtype)
+        out = self._callback_out[:frame_count]
+        for start in range(0, frame_count, self.block_size):
+            frames = min(self.block_size, frame_count - start)
+            out[start:start + frames] = self.render_block(frames)
+        return out
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        # PyAudio treats a short buffer as the end of the stream, so always fill every frame asked for. It wants
+        # bytes; that copy is the only allocation per callback.
+        return self.fill(frame_count).tobytes(), self._continue
+
+    def start(self):
+        import pyaudio
+        self._continue = pyaudio.paContinue
+        self._audio = pyaudio.PyAudio()
+        self._stream = self._audio.open(format=self._audio.get_format_from_width(self.factory.width),
+                                        channels=1,
+                                        rate=self.factory.framerate,
+                                        output=True,
+                                        frames_per_buffer=self.block_size,
+                                        stream_callback=self._callback)
+        self._stream.start_stream()
+
+    def stop(self):
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._audio.terminate()
+            self._stream = self._audio = None
@@ -1,11 +1,18 @@
-import pandas as pd
 import numpy as np
 from music import constants
+from music import envelope
+from music import filters as dsp
+from utils import cache
 from utils import decorator
+from utils import lazy
+
+pd = lazy.lazy_import('pandas')
 
 
 class WmlnMeta(type):
     def __getattr__(cls, item):
+        if item.startswith('_') or not item[-1:].isdigit():
+            raise AttributeError(item)  # e.g. __slots__, looked up when pickling
         octave = int(item[-1])
         return cls(item[:-1], octave)
 
@@ -25,7 +32,9 @@ class BaseNoteObject(object):
 
 
 class _BNO(BaseNoteObject):
-    tuning = constants.WesternTuning('G', constants.minor_ratios, renormalization='G')
+    @lazy.lazy_class_attribute
+    def tuning(cls):
+        return constants.get_tuning('G', constants.minor_ratios, renormalization='G')
 
     def __init__(self, name, octave, duration=1, denom=1):
         self.name = name
@@ -34,6 +43,21 @@ class _BNO(BaseNoteObject):
     def distance(self, other):
         pass
 
+    @property
+    def rank(self):
+        """
+        Diatonic steps above C0, i.e. one per staff line or space (Cs4 and Cf4 share C4's).
+        """
+        return 7 * self.octave + constants.WesternTuning.scale_positions[self.name[0]]
+
+    @classmethod
+    def retune(cls, key, tuning_preferences=constants.minor_ratios, renormalization=None):
+        """
+        Switches the tuning of notes created from now on; existing notes keep their frequencies.
+        """
+        cls.tuning = constants.get_tuning(key, tuning_preferences, renormalization)
+        return cls.tuning
+
 
 class NamedTone(_BNO, metaclass=WmlnMeta):
 
@@ -68,16 +92,26 @@ class MusicLine(object):
         return self
 
 
-melody = (
-    2 * N.D5 + N.G4 + N.A4 + N.B4 + N.C5
-    + 2 * N.D5 + 2 * N.G4 + 2 * N.G4
-    + 2 * N.E5 + N.C5 + N.D5 + N.E5 + N.Fs5
-    + 2 * N.G5 + 2 * N.G4 + 2 * N.G4
-    + 2 * N.C5 + N.D5 + N.C5 + N.B4 + N.A4
-    + 2 * N.B4 + N.C5 + N.B4 + N.A4 + N.G4
-    + 2 * N.Fs4 + N.G4 + N.A4 + N.B4 + N.G4
-    + 6 * N.B4 / 10 + 54 * N.A4 / 10
-)
+def _melody():
+    return (
+        2 * N.D5 + N.G4 + N.A4 + N.B4 + N.C5
+        + 2 * N.D5 + 2 * N.G4 + 2 * N.G4
+        + 2 * N.E5 + N.C5 + N.D5 + N.E5 + N.Fs5
+        + 2 * N.G5 + 2 * N.G4 + 2 * N.G4
+        + 2 * N.C5 + N.D5 + N.C5 + N.B4 + N.A4
+        + 2 * N.B4 + N.C5 + N.B4 + N.A4 + N.G4
+        + 2 * N.Fs4 + N.G4 + N.A4 + N.B4 + N.G4
+        + 6 * N.B4 / 10 + 54 * N.A4 / 10
+    )
+
+
+def __getattr__(name):
+    # ``melody`` is built on first use, so importing this module doesn't need a tuning.
+    if name == 'melody':
+        global melody
+        melody = _melody()
+        return melody
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
 
 
 class Decay(object):
@@ -91,36 +125,35 @@ class Decay(object):
 
 
 class ToneFactory(object):
-    def __init__(self, width, framerate, tempo):
+    block_size = 2048
+
+    def __init__(self, width, framerate, tempo, cache_dir=None):
+        """
+        :param cache_dir: optional directory for persisting rendered buffers across processes
+        """
         self.width = width
         self._width = int(2 ** (width * 8 - 1) - 1)
         self.framerate = int(framerate)
         self.tempo = tempo
+        self.disk_cache = cache.DiskCache(cache_dir) if cache_dir is not None else None
+
+    def _cache_parts(self):
+        return type(self).__name__, self.width, self.framerate, self.tempo
+
+    def __getstate__(self):
+        # In-memory caches stay behind when a factory is sent to another process.
+        state = dict(self.__dict__)
+        state.pop('_memoized', None)
+        return state
 
-    @decorator.memoize_instance_method
+    def sample_count(self, beats):
+        return int(self.tempo * float(beats) * self.framerate)
+
+    @decorator.memoize_instance_method(persist=True)
     def get_linear_decay(self, beats, ampl=1.0, strength=1.0):
-        suffix = pd.Series()
-        length = int(self.tempo * self.framerate * beats)
-        if beats > .4:
-            intermediate = int(self.tempo * self.framerate * 2)
-        else:
-            intermediate = None
-        if strength > 1.0:
-            duration = int(1./strength * length)
-            suffix = pd.Series(0, range(length - duration))
-            length = duration
-            strength = 1.0
-        amplitude = pd.Series(np.nan, range(length))
-        amplitude[0] = 0
-        amplitude[200] = ampl
-        if intermediate is None:
-            amplitude[length - 1] = (ampl * (1 - strength))
-        else:
-            amplitude[intermediate] = ampl * (1 - strength)
-            amplitude[length - 1] = (ampl * (1 - strength)) ** (beats/.4)
-        return pd.concat([amplitude.interpolate(), suffix])
+        return envelope.LinearDecay(ampl, strength).render(self, beats)
 
-    @decorator.memoize_instance_method
+    @decorator.memoize_instance_method(persist=True)
     def render(self, freq, ampl, beats, filters=()):
         baseline = pd.Series(range(int(self.tempo * float(beats) * self.framerate)))
         tone = self._width * ampl * np.sin(freq * (baseline) * np.pi / self.framerate)
@@ -133,14 +166,47 @@ class ToneFactory(object):
         else:
             return tone
 
+    def render_partials(self, freqs, ampls, beats, out=None, dtype=np.float64):
+        """
+        Renders the sum of ``render(freq, ampl, beats)`` over ``zip(freqs, ampls)`` (without filters) in one pass.
+
+        Rather than calling ``np.sin`` for every partial and every sample, one block of
+        ``sin(w * t)``/``cos(w * t)`` is tabulated per partial, and each following block is rotated into place with
+        the angle addition formula, so every block of output is a single matrix-vector product over all partials.
+
+        :param out: optional preallocated buffer of at least ``sample_count(beats)`` samples to render into
+        :return: np.ndarray
+        """
+        n = self.sample_count(beats)
+        out = np.empty(n, dtype) if out is None else out[:n]
+        omegas = np.asarray(freqs, np.float64) * np.pi / self.framerate
+        weights = self._width * np.asarray(ampls, np.float64)
+        size = max(min(self.block_size, n), 1)
+        table = np.empty((2 * len(omegas), size))
+        np.outer(omegas, np.arange(size, dtype=np.float64), out=table[:len(omegas)])
+        np.cos(table[:len(omegas)], out=table[len(omegas):])
+        np.sin(table[:len(omegas)], out=table[:len(omegas)])
+        coefficients = np.empty(2 * len(omegas))
+        for start in range(0, n, size):
+            stop = min(start + size, n)
+            # sin(w * (start + t)) == cos(w * start) * sin(w * t) + sin(w * start) * cos(w * t)
+            np.multiply(weights, np.cos(omegas * start), out=coefficients[:len(omegas)])
+            np.multiply(weights, np.sin(omegas * start), out=coefficients[len(omegas):])
+            out[start:stop] = coefficients @ table[:, :stop - start]
+
+        if self.width == 1:
+            out += self._width * len(omegas)
+        return out
+
 
 def normalize_values(harmonics):
     s = sum(harmonics.values())
     return {k: v/s for k, v in harmonics.items()} if harmonics else {1: 1}
 
 
-def _use_id_for_series(x):
-    return id(x) if isinstance(x, pd.Series) else x
+def _key_by_content(x):
+    # Arrays (envelopes) by their samples: an id could be reused, or the array changed in place since.
+    return cache.stable_hash(x) if isinstance(x, np.ndarray) or lazy.isinstance_of(x, 'pandas', 'Series') else x
 
 
 class HToneFactory(ToneFactory):
@@ -149,44 +215,215 @@ class HToneFactory(ToneFactory):
         # noinspection PyArgumentList
         super().__init__(width, framerate, tempo, **kwargs)
 
-    @decorator.memoize_instance_method(ampl=_use_id_for_series)
+    def _cache_parts(self):
+        return super()._cache_parts() + (self.harmonics, )
+
+    @decorator.memoize_instance_method(persist=True, ampl=_key_by_content)
     def render(self, freq, ampl, beats, filters=()):
+        """
+        :param ampl: a scalar, one amplitude per sample, or an ``envelope.Envelope``
+        """
+        if isinstance(ampl, envelope.Envelope):
+            ampl = ampl.render(self, beats)
+        if not filters:
+            tone = self.render_partials([mult * freq for mult in self.harmonics], list(self.harmonics.values()), beats)
+            tone *= _trim(ampl, len(tone))
+            return tone
+
         tone = None
         for mult, strength in self.harmonics.items():
             t = super(HToneFactory, self).render(mult * freq, strength, beats, filters)
-            if tone is None:
-                tone = t
-            else:
-                tone += t
+            # Never in place: t may be a cached (or read-only, memory mapped) result.
+            tone = t if tone is None else tone + t
 
         return ampl * tone
 
 
+def _trim(ampl, length):
+    """
+    Envelopes from ``get_linear_decay`` can carry stray trailing samples past the end of the note; drop them.
+    """
+    ampl = np.asarray(ampl, np.float64)
+    return ampl[:length] if ampl.ndim else ampl
+
+
+class WavetableToneFactory(HToneFactory):
+    """
+    An ``HToneFactory`` that plays its harmonic partials (whole multiples of the fundamental) back from one
+    precomputed period of their combined waveform, so their cost per sample does not grow with their number.
+
+    Inharmonic partials (such as ``Harmonics.inharmonic``) cannot share a period with the rest; they fall back to
+    the additive oscillator bank of ``render_partials``.
+
+    With linear interpolation the error is at most ``(2 * pi / table_size) ** 2 / 8 * sum(s * m ** 2)`` (times the
+    sample width) for partials ``m`` of strength ``s``, e.g. under 1e-5 of full scale for ``Harmonics.decayed`` with
+    the default table. Cubic (Catmull-Rom) interpolation shrinks the error by roughly another factor of
+    ``table_size / m``; see ``max_error``.
+    """
+
+    def __init__(self, width, framerate, tempo, harmonics, table_size=4096, interpolation='linear',
+                 tolerance=1e-9, **kwargs):
+        if interpolation not in ('linear', 'cubic'):
+            raise ValueError('Unknown interpolation {!r}'.format(interpolation))
+        # noinspection PyArgumentList
+        super().__init__(width, framerate, tempo, harmonics, **kwargs)
+        self.table_size = table_size
+        self.interpolation = interpolation
+        self.table_harmonics = {int(round(m)): s for m, s in self.harmonics.items()
+                                if round(m) >= 1 and abs(m - round(m)) <= tolerance}
+        self.inharmonics = {m: s for m, s in self.harmonics.items()
+                            if not (round(m) >= 1 and abs(m - round(m)) <= tolerance)}
+        phases = 2 * np.pi * np.arange(table_size) / table_size
+        table = np.zeros(table_size)
+        for mult, strength in self.table_harmonics.items():
+            table += strength * np.sin(mult * phases)
+        # Pad so interpolation never has to wrap: one sample before the period and two after.
+        self.table = np.concatenate((table[-1:], table, table[:2]))
+
+    def _cache_parts(self):
+        return super()._cache_parts() + (self.table_size, self.interpolation)
+
+    def max_error(self):
+        """
+        The worst interpolation error over one period, measured against the exact waveform at 16x the table
+        resolution (as a fraction of full scale).
+        """
+        fine = np.arange(16 * self.table_size) / 16.
+        exact = np.zeros(len(fine))
+        for mult, strength in self.table_harmonics.items():
+            exact += strength * np.sin(2 * np.pi * mult * fine / self.table_size)
+        return float(np.abs(self._lookup(fine) - exact).max())
+
+    def _lookup(self, positions):
+        i = positions.astype(np.intp)
+        frac = positions - i
+        t = self.table
+        if self.interpolation == 'linear':
+            y0 = t[i + 1]
+            return y0 + frac * (t[i + 2] - y0)
+        p0, p1, p2, p3 = t[i], t[i + 1], t[i + 2], t[i + 3]
+        return p1 + .5 * frac * (p2 - p0 + frac * (2 * p0 - 5 * p1 + 4 * p2 - p3 + frac * (3 * (p1 - p2) + p3 - p0)))
+
+    def render_table(self, freq, beats, out=None):
+        """
+        Renders the harmonic partials at fundamental ``freq``, without the offset ``render_partials`` adds at width 1.
+        """
+        n = self.sample_count(beats)
+        out = np.zeros(n) if out is None else out[:n]
+        # render() takes freq * pi / framerate radians per sample, i.e. freq / (2 * framerate) periods.
+        increment = freq * self.table_size / (2. * self.framerate)
+        size = max(min(self.block_size, n), 1)
+        positions = np.empty(size)
+        for start in range(0, n, size):
+            stop = min(start + size, n)
+            pos = positions[:stop - start]
+            np.multiply(np.arange(start, stop, dtype=np.float64), increment, out=pos)
+            np.mod(pos, self.table_size, out=pos)
+            out[start:stop] += self._width * self._lookup(pos)
+        return out
+
+    @decorator.memoize_instance_method(persist=True, ampl=_key_by_content)
+    def render(self, freq, ampl, beats, filters=()):
+        if isinstance(ampl, envelope.Envelope):
+            ampl = ampl.render(self, beats)
+        if filters:
+            return HToneFactory.render._wrapped(self, freq, ampl, beats, filters)
+
+        if self.inharmonics:
+            tone = self.render_partials([m * freq for m in self.inharmonics], list(self.inharmonics.values()), beats)
+        else:
+            tone = np.zeros(self.sample_count(beats))
+        self.render_table(freq, beats, out=tone)
+        if self.width == 1:
+            tone += self._width * len(self.table_harmonics)
+        tone *= _trim(ampl, len(tone))
+        return tone
+
+
+def mix_into(out, buffers, offsets=None, mode='sum', limit=1.0):
+    """
+    Mixes ``buffers`` into ``out`` in place (its current contents count as one more voice), in time linear in the
+    number of voices and without recursion.
+
+    :param offsets: where in ``out`` each buffer starts (default 0); buffers running past the end are cut off
+    :param mode: 'sum' just adds; 'hard' then clips to +-``limit``; 'soft' then applies ``limit * tanh(x / limit)``;
+        'saturate' clips each voice to +-``limit``, then combines same-signed voices as ``1 - prod(1 - |x| / limit)``
+        (in units of ``limit``) so they approach the limit instead of passing it, while opposite-signed voices still
+        add (as ``DecayedCombiner``)
+    :return: out
+    """
+    if mode not in ('sum', 'hard', 'soft', 'saturate'):
+        raise ValueError('Unknown mix mode {!r}'.format(mode))
+    offsets = [0] * len(buffers) if offsets is None else offsets
+    if mode != 'saturate':
+        for buffer, offset in zip(buffers, offsets):
+            buffer = np.asarray(buffer)[:max(len(out) - offset, 0)]
+            out[offset:offset + len(buffer)] += buffer
+        if mode == 'hard':
+            np.clip(out, -limit, limit, out=out)
+        elif mode == 'soft':
+            out /= limit
+            np.tanh(out, out=out)
+            out *= limit
+        return out
+
+    # Track prod(1 - positive part) and prod(1 - negative part) separately; the result is their difference.
+    positive = np.ones(len(out))
+    negative = np.ones(len(out))
+    scratch = np.empty(len(out))
+    factor = np.empty(len(out))
+    for buffer, offset in [(out, 0)] + list(zip(buffers, offsets)):
+        buffer = np.asarray(buffer)[:max(len(out) - offset, 0)]
+        segment = slice(offset, offset + len(buffer))
+        x, f = scratch[:len(buffer)], factor[:len(buffer)]
+        np.multiply(buffer, -1. / limit, out=x)
+        np.clip(x, 0, 1, out=f)
+        np.subtract(1, f, out=f)
+        negative[segment] *= f
+        np.clip(x, -1, 0, out=f)
+        f += 1
+        positive[segment] *= f
+    np.subtract(negative, positive, out=out)
+    out *= limit
+    return out
+
+
+def mix(buffers, offsets=None, length=None, mode='sum', limit=1.0):
+    """
+    Mixes ``buffers`` into a new buffer of ``length`` samples (by default, long enough for all of them); see
+    ``mix_into``.
+    """
+    offsets = [0] * len(buffers) if offsets is None else offsets
+    if length is None:
+        length = max([offset + len(buffer) for buffer, offset in zip(buffers, offsets)], default=0)
+    return mix_into(np.zeros(length), buffers, offsets, mode=mode, limit=limit)
+
+
+def _align(primary, secondary):
+    """
+    Resamples ``secondary`` onto ``primary``'s index (interpolating between its samples, silent outside them), or,
+    for plain arrays, pads or cuts it to ``primary``'s length.
+    """
+    if lazy.isinstance_of(primary, 'pandas', 'Series') and lazy.isinstance_of(secondary, 'pandas', 'Series'):
+        union = secondary.index.union(primary.index)
+        secondary = secondary.reindex(union).interpolate(method='index', limit_area='inside')
+        return secondary.reindex(primary.index).fillna(0).to_numpy(np.float64)
+    return np.asarray(secondary, np.float64)[:len(primary)]
+
+
 class Combiner(object):
+    mode = 'hard'
+
     def combine(self, primary, *secondaries):
-        secondaries = [secondary.reindex(primary).iterpolate().fillna(0) for secondary in secondaries]
-        secondary = sum(secondaries)
-        result = primary + sum(secondary)
-        result[result > 1] = 1.
-        result[result < -1] = -1.
-        return result
+        result = np.array(primary, np.float64)
+        mix_into(result, [_align(primary, secondary) for secondary in secondaries], mode=self.mode)
+        return pd.Series(result, primary.index) if lazy.isinstance_of(primary, 'pandas', 'Series') else result
 
 
 class DecayedCombiner(Combiner):
-    def combine(self, primary, *secondaries):
-        if len(secondaries) == 1:
-            secondary = secondaries[0]
-        else:
-            secondary = self.combine(*secondaries)
-        secondary = secondary.reindex(primary).interpolate().fillna(0)
-        sign = pd.np.sign(primary)
-        result = primary + secondary
-        result[pd.np.sign(secondary) == sign] = sign * (1 - (1 - abs(primary)) * (1 - abs(secondary)))
-        return result
-
+    mode = 'saturate'
 
 
 def harsher(tone, *_):
-    signs = (tone / tone.abs()).fillna(0)
-    return np.sqrt(tone.abs().mean() * tone.abs()) * signs
+    return dsp.Harsher()(tone)
 
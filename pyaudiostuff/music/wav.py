@@ -0,0 +1,101 @@
+import struct
+
+import numpy as np
+
+SIZES = {1: np.uint8, 2: np.int16, 4: np.int32, 8: np.int64}
+CHUNK = 1024 * 64
+HEADER = struct.Struct('<4sI4s4sIHHIIHH4sI')
+
+
+def quantize(block, width, dither=True, rng=None):
+    """
+    Rounds float samples (already scaled to the sample width, as ``ToneFactory`` renders them) to PCM integers,
+    with optional triangular dither of one step and clipping to the integer range.
+    """
+    dtype = SIZES[width]
+    info = np.iinfo(dtype)
+    x = np.array(block, np.float64)
+    if dither:
+        rng = np.random.default_rng() if rng is None else rng
+        x += rng.random(x.shape)
+        x -= rng.random(x.shape)
+    np.rint(x, out=x)
+    np.clip(x, info.min, info.max, out=x)
+    return x.astype(dtype)
+
+
+class WaveWriter(object):
+    """
+    Writes a PCM WAV file block by block, quantizing each block as it arrives.
+
+    The header goes out first with placeholder sizes, which ``close`` patches. Given ``nframes`` up front, the file
+    is instead preallocated and its samples memory mapped (``samples``), so blocks are copied straight into the
+    page cache; if fewer frames than that were written, ``close`` cuts the file down to them.
+    """
+
+    def __init__(self, filename, framerate, width, channels=1, dither=True, nframes=None, rng=None):
+        self.filename = filename
+        self.framerate = framerate
+        self.width = width
+        self.channels = channels
+        self.dither = dither
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.frames = 0
+        self.samples = None
+        self._file = open(filename, 'wb' if nframes is None else 'w+b')
+        self._write_header(nframes or 0)
+        if nframes is not None:
+            self._file.truncate(HEADER.size + nframes * channels * width)
+            self._file.flush()
+            self.samples = np.memmap(self._file, SIZES[width], 'r+', offset=HEADER.size, shape=(nframes * channels, ))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _write_header(self, nframes):
+        data = nframes * self.channels * self.width
+        self._file.seek(0)
+        self._file.write(HEADER.pack(b'RIFF', 36 + data, b'WAVE', b'fmt ', 16, 1, self.channels, self.framerate,
+                                     self.framerate * self.channels * self.width, self.channels * self.width,
+                                     8 * self.width, b'data', data))
+
+    def write(self, block):
+        """
+        Appends a block of float samples (interleaved if there are several channels), ``CHUNK`` samples at a time.
+        """
+        block = np.asarray(block).reshape(-1)
+        for start in range(0, len(block), CHUNK):
+            pcm = quantize(block[start:start + CHUNK], self.width, self.dither, self.rng)
+            position = self.frames * self.channels
+            if self.samples is not None:
+                if position + len(pcm) > len(self.samples):
+                    raise ValueError('Wrote past the {} frames allocated'.format(len(self.samples) // self.channels))
+                self.samples[position:position + len(pcm)] = pcm
+            else:
+                self._file.write(pcm.astype(pcm.dtype.newbyteorder('<'), copy=False).tobytes())
+            self.frames += len(pcm) // self.channels
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self.samples is not None:
+            self.samples.flush()
+            self.samples = None
+            self._file.truncate(HEADER.size + self.frames * self.channels * self.width)
+        self._write_header(self.frames)
+        self._file.close()
+
+
+def write_blocks(filename, framerate, width, blocks, **kwargs):
+    """
+    Writes an iterable of float blocks (or a single buffer) to ``filename``.
+    """
+    if isinstance(blocks, np.ndarray) or hasattr(blocks, 'to_numpy'):
+        blocks = [blocks]
+    with WaveWriter(filename, framerate, width, **kwargs) as writer:
+        for block in blocks:
+            writer.write(block)
+    return writer.frames
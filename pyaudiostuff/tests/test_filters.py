@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from music import filters
+
+
+def _recurrence(b, a, x):
+    y = np.zeros(len(x))
+    for n in range(len(x)):
+        y[n] = sum(b[k] * x[n - k] for k in range(len(b)) if n >= k)
+        y[n] -= sum(a[k] * y[n - k] for k in range(1, len(a)) if n >= k)
+    return y
+
+
+STAGES = [filters.OnePoleLowPass(500, 22050), filters.OnePoleHighPass(500, 22050)] + \
+    [filters.Biquad(kind, 1000, 22050, gain_db=6) for kind in filters.Biquad.kinds]
+
+
+@pytest.mark.parametrize('stage', STAGES, ids=lambda s: getattr(s, 'kind', type(s).__name__))
+def test_linear_filters_match_their_recurrence(stage):
+    x = np.random.default_rng(0).normal(size=1000)
+    expected = _recurrence(*stage.coefficients(), x)
+    assert np.allclose(stage(x), expected, atol=1e-12)
+    stage.reset()
+    blocks = [stage.process(part.copy()) for part in np.array_split(x, [1, 2, 70, 71, 600])]
+    assert np.allclose(np.concatenate(blocks), expected, atol=1e-12)
+
+
+def test_linear_filter_processes_in_place():
+    stage = filters.Biquad('lowpass', 1000, 22050)
+    block = np.ones(256)
+    assert stage.process(block) is block
+    scratch = stage._input
+    stage.process(block)
+    assert stage._input is scratch
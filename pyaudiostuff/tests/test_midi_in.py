@@ -0,0 +1,94 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from music import midi_in
+
+
+class _Sink(object):
+    def __init__(self):
+        self.calls = []
+
+    def note_on(self, key, velocity):
+        self.calls.append(('on', key))
+
+    def note_off(self, key):
+        self.calls.append(('off', key))
+
+    def sustain_pedal(self, depressed):
+        pass
+
+    def sostenuto_pedal(self, depressed):
+        pass
+
+    def soft_pedal(self, depressed):
+        pass
+
+
+def _listen(events):
+    sink = _Sink()
+    source = midi_in.FakeEventSource(events)
+    source.close()
+    listener = midi_in.LiveListener(sinks=[sink], source=source)
+    listener.listen()
+    return listener, sink
+
+
+def test_unmatched_note_off_is_ignored():
+    note = midi_in.FakeEventSource.note
+    listener, sink = _listen([note(60, 0), note(62, 80), note(62, 0), note(62, 0), note(64, 80)])
+    assert sink.calls == [('off', 40), ('on', 42), ('off', 42), ('off', 42), ('on', 44)]
+    assert list(listener.notes.piano_key) == [42, 44]
+    assert listener.sounding_notes.keys() == {44}
+
+
+def test_bad_event_does_not_stop_listening(capsys):
+    class Broken(_Sink):
+        def note_on(self, key, velocity):
+            if key == 40:
+                raise ValueError('broken sink')
+            super().note_on(key, velocity)
+
+    sink = Broken()
+    source = midi_in.FakeEventSource([midi_in.FakeEventSource.note(60, 80), midi_in.FakeEventSource.note(62, 80)])
+    source.close()
+    midi_in.LiveListener(sinks=[sink], source=source).listen()
+    assert sink.calls == [('on', 42)]
+    assert 'broken sink' in capsys.readouterr().err
+
+
+def _chords(starts):
+    return [midi_in.Chord(midi_in.RawMidiNote(start=start, end=start + .1, piano_key=40, velocity=80))
+            for start in starts]
+
+
+def _infer_rhythm_loop(chords, hint=.02, var=.20, most_common=1, sequence=(1, 2, 3, 4, 8)):
+    """
+    ``infer_rhythm`` as it was before it delegated to ``infer_rhythm_array``.
+    """
+    mult = int(1/hint)
+    raw = pd.Series([b.start - a.start for a, b in zip(chords, chords[1:])])
+    counts = pd.Series([int(mult * r) for r in raw]).value_counts()
+    mode = hint * counts.idxmax()
+    best_guess = raw[((1 - var) * mode < raw) & (raw < (1 + var) * mode)].mean() / most_common
+    denoms = pd.Series(np.nan, range(len(raw)))
+    for i in reversed(sequence):
+        s = i * raw / best_guess
+        denoms[(s - s.round()).abs() < var] = i
+    return pd.DataFrame(dict(nums=(denoms * raw / best_guess).round(), denoms=denoms, raw=raw, bg=best_guess))
+
+
+@pytest.mark.parametrize('starts', [
+    [0, .5, 1., 1.25, 1.5, 2., 2.75, 3., 4.],  # quarters, eighths, a dotted eighth, a half
+    [0, .49, 1.02, 1.5, 1.74, 2.01, 2.49],  # played a little unevenly
+    [0, .01, .02, .03],  # every interval falls in bin 0, so the window around the mode is empty
+])
+def test_infer_rhythm_array_matches_loop(starts):
+    chords = _chords(starts)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        result = midi_in.infer_rhythm(chords)
+    pd.testing.assert_frame_equal(result, _infer_rhythm_loop(chords), check_dtype=False)
+    assert result.bg.isna().all() == (starts[1] < .02)
@@ -0,0 +1,20 @@
+import numpy as np
+
+from music import render, tone
+
+
+class _CountingFactory(tone.HToneFactory):
+    pickled = 0
+
+    def __getstate__(self):
+        type(self).pickled += 1
+        return super().__getstate__()
+
+
+def test_processes_get_the_factory_once_per_worker():
+    f = _CountingFactory(2, 8000, 1, harmonics={1: 1, 2: .5})
+    expected = render.render_line_parallel(f, tone.melody)
+    assert _CountingFactory.pickled == 0
+    result = render.render_line_parallel(f, tone.melody, workers=2, processes=True, chunk=1)
+    assert len(tone.melody.notes) > 2 and _CountingFactory.pickled <= 2
+    assert np.array_equal(result, expected)
@@ -0,0 +1,69 @@
+import pytest
+
+pygame = pytest.importorskip('pygame')
+
+from music import sheet_music as sm
+from music.tone import NamedTone as N
+
+
+def _dark(screen, rect):
+    surface = screen.screen.subsurface(rect)
+    return sum(1 for x in range(rect.width) for y in range(rect.height) if sum(surface.get_at((x, y))[:3]) < 384)
+
+
+def test_key_signature_positions():
+    treble, bass = sm.GreatStaff(0, 0, 100, 36).sub_staves
+    d = sm.key_signature('D')
+    assert treble.signature_positions(d) == [(1, 0), (1, 3)]  # F5 on the top line, C5 in the third space
+    assert bass.signature_positions(d) == [(1, 2), (1, 5)]
+    assert [sign for sign, _ in treble.signature_positions(sm.key_signature('Ef'))] == [-1, -1, -1]
+    assert [type(glyph) for glyph in treble.signature_glyphs(d)] == [tuple, tuple]
+
+
+def test_engrave_draws_the_key_signature():
+    line = [N('Fs', 4), N('Cs', 5), N('D', 4), N('A', 4)]  # all in D major: no accidentals next to the notes
+    in_d, in_c = sm.engrave(line, width=400, key='D'), sm.engrave(line, width=400, key='C')
+    staff = in_d.staves[0]
+    assert staff.signature_width > 0 and in_c.staves[0].signature_width == 0
+    signature = pygame.Rect(staff.left + 2, staff.top - staff.space, staff.signature_width - 2, 3 * staff.space)
+    assert _dark(in_d, signature) > 2 * _dark(in_c, signature)  # in C only staff lines and a note head
+    # The notes moved right to make room, and none of them needs a sign of its own.
+    assert min(note.x for note in staff.notes) >= staff.signature_width
+    assert all(note.accidental is None for note in staff.notes)
+
+
+class _Tracker(object):
+    """
+    Quarter notes at 120 bpm, exactly.
+    """
+    threshold = .02
+
+    def __init__(self):
+        self.chord_start = None
+
+    def add_note(self, start):
+        if self.chord_start is not None and start - self.chord_start < self.threshold:
+            return None
+        last, self.chord_start = self.chord_start, start
+        return None if last is None else sm.midi_in.Quantized(round((start - last) * 8), 4, None, None)
+
+
+def test_live_layout_matches_engraving():
+    # (seconds, piano key): chords, a second (shifted), sharps and their naturals, a note across a barline
+    played = [(0, 40), (0, 44), (.5, 41), (.75, 40), (1., 45), (1., 47), (2.5, 42), (3., 40), (3.5, 52)]
+    layout = sm.LiveLayout(tracker=_Tracker())
+    for start, key in played:
+        layout.add_note(start, key)
+    staff = sm.LiveStaff(0, 0, 2000, 36)
+    for change in layout.changes:
+        staff.set_tail(*change[1:]) if change[0] == 'tail' else staff.add_bar(change[1])
+
+    starts = sorted(set(start for start, _ in played))
+    beats = {start: 2 * (end - start) for start, end in zip(starts, starts[1:] + [starts[-1] + .5])}
+    notes = [sm.renderable(sm.piano_key_tone(key), 2 * start, beats[start]) for start, key in played]
+    engraved = sm.ScoreLayout(sm.split_measures(notes))
+    expected = [sm.live_note(x, note) for x, note in engraved.placed()]
+    order = lambda n: (n.x, n.sub_staff, n.position)
+    assert sorted(staff.notes, key=order) == sorted(expected, key=order)
+    assert staff.bars == [int(x) for x in engraved.starts[1:len(engraved.measures)]]
+    assert any(note.accidental == 1 for note in staff.notes) and any(note.accidental == 0 for note in staff.notes)
@@ -0,0 +1,26 @@
+import numpy as np
+
+from music import synth
+from music import tone
+
+
+def _synth(**kwargs):
+    factory = tone.HToneFactory(2, 22050, 1, harmonics={1: 1, 2: .5})
+    return synth.Synth(factory, block_size=256, **kwargs)
+
+
+def test_callback_fills_requests_larger_than_a_block():
+    s, reference = _synth(), _synth()
+    for engine in (s, reference):
+        engine.note_on(40, 100)
+    data, flag = s._callback(None, 600, None, 0)
+    assert len(data) == 600 * 2 and flag is s._continue
+    expected = np.concatenate([reference.render_block(n).copy() for n in (256, 256, 88)])
+    assert np.array_equal(np.frombuffer(data, '<i2'), expected)
+    assert s.blocks == 3
+
+
+def test_callback_smaller_than_a_block():
+    s = _synth()
+    s.note_on(40, 100)
+    assert len(s._callback(None, 100, None, 0)[0]) == 200
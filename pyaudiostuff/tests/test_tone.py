@@ -0,0 +1,23 @@
+import numpy as np
+
+from music import tone
+
+
+def test_saturate_stays_monotonic_above_the_limit():
+    assert tone.mix([np.array([1.5])], mode='saturate')[0] == 1.
+    assert tone.mix([np.array([1.5]), np.array([1.5])], mode='saturate')[0] == 1.
+    assert tone.mix([np.array([-3.]), np.array([.5])], mode='saturate')[0] == -.5
+    x = np.linspace(0, 3, 301)
+    mixed = tone.mix([x, np.full_like(x, .5)], mode='saturate')
+    assert np.all(np.diff(mixed) >= 0) and mixed.max() <= 1.
+    assert np.allclose(tone.mix([np.array([.5]), np.array([.5])], mode='saturate'), .75)
+
+
+def test_render_keys_envelopes_by_content():
+    f = tone.HToneFactory(2, 8000, 1, harmonics={1: 1})
+    envelope = np.linspace(1, 0, f.sample_count(1))
+    first = f.render(440., envelope, 1).copy()
+    envelope *= .5
+    assert np.allclose(f.render(440., envelope, 1), first * .5)
+    assert np.array_equal(f.render(440., envelope.copy(), 1), f.render(440., envelope, 1))
+    assert f.render.cache_info(f).hits >= 1
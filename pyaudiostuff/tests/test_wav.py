@@ -0,0 +1,22 @@
+import wave
+
+import numpy as np
+import pytest
+
+from music import wav
+
+
+@pytest.mark.parametrize('nframes', [None, 1000])
+def test_round_trip_writing_fewer_frames_than_declared(tmp_path, nframes):
+    filename = str(tmp_path / 'short.wav')
+    samples = np.arange(300.) * 100
+    with wav.WaveWriter(filename, 8000, 2, dither=False, nframes=nframes) as writer:
+        writer.write(samples)
+    with wave.open(filename) as f:
+        assert f.getnframes() == 300
+        assert np.array_equal(np.frombuffer(f.readframes(2000), '<i2'), samples)
+    assert (tmp_path / 'short.wav').stat().st_size == wav.HEADER.size + 300 * 2
+
+
+def test_quantize_clips():
+    assert list(wav.quantize([4e4, -4e4, 100.4], 2, dither=False)) == [32767, -32768, 100]
@@ -0,0 +1,209 @@
+import collections
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import types
+
+import numpy as np
+
+from utils import lazy
+
+pd = lazy.lazy_import('pandas')
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'max_bytes', 'currsize', 'nbytes'])
+
+MISSING = object()
+
+
+def payload_size(value):
+    """
+    Best guess at the number of bytes kept alive by a cached value.
+    """
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, int):  # np.ndarray (and np.memmap)
+        return nbytes
+    memory_usage = getattr(value, 'memory_usage', None)
+    if memory_usage is not None:  # pd.Series / pd.DataFrame
+        usage = memory_usage(index=True)
+        return int(usage.sum()) if hasattr(usage, 'sum') else int(usage)
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(payload_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache(object):
+    """
+    A dict-like cache that evicts its least recently used entries once it holds more than ``maxsize`` entries or
+    more than ``max_bytes`` bytes of payload. ``None`` means unbounded.
+    """
+
+    def __init__(self, maxsize=None, max_bytes=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._data = collections.OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = payload_size(value)
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._sizes[key]
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self._sizes[key] = size
+            self.nbytes += size
+            while self._data and ((self.maxsize is not None and len(self._data) > self.maxsize)
+                                  or (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+                old, _ = self._data.popitem(last=False)
+                self.nbytes -= self._sizes.pop(old)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, self.max_bytes,
+                         len(self._data), self.nbytes)
+
+
+def stable_hash(obj):
+    """
+    A hex digest of ``obj`` that is stable across processes (unlike ``hash`` or ``id``).
+
+    Arrays and pandas objects are hashed by content, functions by their qualified name, code (bytecode, constants
+    and names), defaults and closure contents, bound methods by their function and instance, and objects that
+    define ``_cache_parts`` by those parts.
+
+    :raises TypeError: if ``obj`` contains something with no stable representation
+    """
+    h = hashlib.sha1()
+    _feed(h, obj)
+    return h.hexdigest()
+
+
+def _feed(h, obj):
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes)):
+        h.update('{}:{!r};'.format(type(obj).__name__, obj).encode())
+    elif isinstance(obj, (tuple, list)):
+        h.update('{}:{};'.format(type(obj).__name__, len(obj)).encode())
+        for item in obj:
+            _feed(h, item)
+    elif isinstance(obj, frozenset):
+        h.update('frozenset:{};'.format(len(obj)).encode())
+        for item in sorted(obj, key=repr):
+            _feed(h, item)
+    elif isinstance(obj, dict):
+        h.update('dict:{};'.format(len(obj)).encode())
+        for k, v in sorted(obj.items(), key=lambda kv: repr(kv[0])):
+            _feed(h, k)
+            _feed(h, v)
+    elif isinstance(obj, (np.ndarray, np.generic)) or hasattr(obj, 'to_numpy'):
+        arr = np.ascontiguousarray(obj.to_numpy() if hasattr(obj, 'to_numpy') else obj)
+        if arr.dtype.hasobject:
+            raise TypeError('Cannot build a stable cache key for an object array')
+        h.update('array:{}:{};'.format(arr.dtype.str, arr.shape).encode())
+        h.update(arr.view(np.uint8).reshape(-1) if arr.size else b'')
+    elif hasattr(obj, '_cache_parts'):
+        h.update('{}:'.format(type(obj).__qualname__).encode())
+        _feed(h, obj._cache_parts())
+    elif isinstance(obj, types.MethodType):
+        h.update(b'method;')
+        _feed(h, obj.__func__)
+        _feed(h, obj.__self__)
+    elif isinstance(obj, types.CodeType):
+        h.update('code:{};'.format(len(obj.co_code)).encode())
+        h.update(obj.co_code)
+        _feed(h, (obj.co_consts, obj.co_names))
+    elif isinstance(obj, types.FunctionType):
+        h.update('function:{}.{};'.format(obj.__module__, obj.__qualname__).encode())
+        _feed(h, obj.__code__)
+        _feed(h, (obj.__defaults__, obj.__kwdefaults__))
+        try:
+            cells = tuple(cell.cell_contents for cell in obj.__closure__ or ())
+        except ValueError:  # an empty cell
+            raise TypeError('Cannot build a stable cache key for {!r}'.format(obj))
+        _feed(h, cells)
+    else:
+        raise TypeError('Cannot build a stable cache key for {!r}'.format(type(obj)))
+
+
+class DiskCache(object):
+    """
+    Stores array results as ``.npy`` files under ``directory``, keyed by ``stable_hash`` digests.
+
+    Cached arrays are loaded back memory mapped (read-only by default), so a warm start only pages in the samples
+    that are actually used. A ``pd.Series`` with a default index is stored as its values and comes back as a
+    ``pd.Series`` over the mapped array, so warm and cold calls return the same type; other pandas objects are
+    not stored.
+    """
+
+    def __init__(self, directory, mmap_mode='r'):
+        self.directory = directory
+        self.mmap_mode = mmap_mode
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key, series=False):
+        return os.path.join(self.directory, key[:2], key + ('.series.npy' if series else '.npy'))
+
+    def get(self, key, default=None):
+        for series in (False, True):
+            try:
+                value = np.load(self.path(key, series), mmap_mode=self.mmap_mode, allow_pickle=False)
+            except (OSError, ValueError):
+                continue
+            self.hits += 1
+            return pd.Series(value, copy=False) if series else value
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        series = lazy.isinstance_of(value, 'pandas', 'Series')
+        if series:
+            if not value.index.equals(pd.RangeIndex(len(value))):
+                return
+        elif not isinstance(value, np.ndarray):
+            return
+        arr = np.asarray(value)
+        if arr.dtype.hasobject:
+            return
+        path = self.path(key, series)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, arr, allow_pickle=False)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.writes += 1
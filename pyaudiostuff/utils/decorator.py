@@ -2,6 +2,8 @@ import functools
 import inspect
 import abc
 
+from utils import cache
+
 
 class OptionallyParamatizableDecorator(object, metaclass=abc.ABCMeta):
     def __new__(cls, _fn=None, **kwargs):
@@ -20,15 +22,44 @@ class FunctionMixin(OptionallyParamatizableDecorator):
         def expanded(_, *args, **kwargs):
             return fn(*args, **kwargs)
 
-        f = functools.wraps(fn)(functools.partial(super(FunctionMixin, self).__call__(expanded), expanded))
+        method = super(FunctionMixin, self).__call__(expanded)
+        f = functools.wraps(fn)(functools.partial(method, expanded))
         f._wrapped = fn
+        if hasattr(method, 'cache_info'):
+            f.cache_info = functools.partial(method.cache_info, expanded)
+            f.cache_clear = functools.partial(method.cache_clear, expanded)
         return f
 
 
 class memoize_instance_method(OptionallyParamatizableDecorator):
-    def __init__(self, **kwargs):
+    """
+    Memoizes a method per instance.
+
+    Keyword arguments naming parameters of the method map those arguments to hashable cache keys. ``maxsize`` and
+    ``max_bytes`` bound the cache, evicting least recently used results; ``fn.cache_info(instance)`` reports
+    hits, misses and evictions.
+
+    With ``persist=True``, results missing from memory are also looked up in (and saved to) ``instance.disk_cache``
+    when the instance has one. Those keys hash the raw arguments by content along with ``instance._cache_parts()``,
+    so they stay valid across processes.
+    """
+    def __init__(self, maxsize=None, max_bytes=None, persist=False, **kwargs):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.persist = persist
         self.kwargs = kwargs
 
+    def _get_cache(self, s, fn):
+        if not hasattr(s, '_memoized'):
+            s._memoized = {}
+        try:
+            return s._memoized[fn.__qualname__]
+        except KeyError:
+            return s._memoized.setdefault(fn.__qualname__, cache.LRUCache(self.maxsize, self.max_bytes))
+
+    def _get_disk_cache(self, s):
+        return getattr(s, 'disk_cache', None) if self.persist else None
+
     def __call__(self, fn):
         _params = inspect.signature(fn).parameters.values()
         po = inspect.Parameter.POSITIONAL_ONLY
@@ -37,22 +68,32 @@ class memoize_instance_method(OptionallyParamatizableDecorator):
 
         @functools.wraps(fn)
         def f(s, *args, **kwargs):
-            if not hasattr(s, '_memoized'):
-                s._memoized = {}
-            _args = []
-            _args.extend(zip(params, args))
-            _args.extend(kwargs.items())
-            _args = sorted([(k, self.kwargs[k](v)) if k in self.kwargs else (k, v) for k, v in _args])
+            memoized = self._get_cache(s, fn)
+            raw = sorted(list(zip(params, args)) + list(kwargs.items()), key=lambda kv: kv[0])
+            _args = [(k, self.kwargs[k](v)) if k in self.kwargs else (k, v) for k, v in raw]
             _args.extend(args[len(params):])
-            key = (fn.__name__, tuple(_args))
-            if key in s._memoized:
-                val = s._memoized[key]
-            else:
-                val = fn(s, *args, **kwargs)
-                s._memoized[key] = val
+            key = tuple(_args)
+            val = memoized.get(key, cache.MISSING)
+            if val is cache.MISSING:
+                disk, disk_key = self._get_disk_cache(s), None
+                if disk is not None:
+                    try:
+                        disk_key = cache.stable_hash(
+                            (fn.__qualname__, getattr(s, '_cache_parts', tuple)(), raw, args[len(params):]))
+                    except TypeError:
+                        pass
+                    else:
+                        val = disk.get(disk_key, cache.MISSING)
+                if val is cache.MISSING:
+                    val = fn(s, *args, **kwargs)
+                    if disk_key is not None:
+                        disk.put(disk_key, val)
+                memoized.put(key, val)
             return val
 
         f._wrapped = fn
+        f.cache_info = lambda s: self._get_cache(s, fn).info()
+        f.cache_clear = lambda s: self._get_cache(s, fn).clear()
         return f
 
 
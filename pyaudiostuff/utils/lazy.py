@@ -0,0 +1,63 @@
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stands in for a module that is only imported the first time one of its attributes is used, so importing
+    code that depends on it stays cheap (and works where the module is not installed, until it is needed).
+    """
+
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self.__name__)
+        return self._module
+
+    def __getattr__(self, item):
+        return getattr(self._load(), item)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        return '<lazy module {!r}{}>'.format(self.__name__, '' if self._module is None else ' (loaded)')
+
+
+def lazy_import(name):
+    """
+    :return: ``sys.modules[name]`` if it is already imported, else a ``LazyModule`` for it
+    """
+    return sys.modules.get(name) or LazyModule(name)
+
+
+def isinstance_of(obj, module, name):
+    """
+    ``isinstance(obj, module.name)`` without importing ``module``: if it was never imported, ``obj`` can't be one.
+    """
+    loaded = sys.modules.get(module)
+    return loaded is not None and isinstance(obj, getattr(loaded, name))
+
+
+class lazy_class_attribute(object):
+    """
+    A class attribute computed by ``fn(cls)`` on first access and then stored on the class that defined it.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.__doc__ = fn.__doc__
+
+    def __get__(self, instance, owner):
+        for cls in owner.__mro__:
+            if cls.__dict__.get(self.fn.__name__) is self:
+                break
+        else:
+            cls = owner
+        value = self.fn(cls)
+        setattr(cls, self.fn.__name__, value)
+        return value